@@ -9,10 +9,12 @@ import badge.events as evt
 from adafruit_display_text.label import Label
 from badge.log import log
 from badge.buttons import all_tasks
+from badge.app import build_app_index
 from badge.buttons import any_button_downup
 from badge.constants import BB_HEIGHT
 from badge.constants import BB_WIDTH
 from badge.constants import SITE_BLUE
+from badge.launcher import forget_app
 from badge.screens import LCD
 from badge.screens import EPD
 from badge.screens import center_text_x_plane
@@ -23,6 +25,8 @@ from badge.screens import round_button
 from badge.screens import wrap_message
 from badge.utils import download_file
 from badge.wifi import WIFI
+from badge_nvm import nvm_app_prefix
+from badge_nvm import nvm_free_prefix
 from displayio import Bitmap
 from displayio import Group
 from displayio import Palette
@@ -145,15 +149,24 @@ class AppStore:
                     self.draw_msg("Deleting app")
                     try:
                         self.delete_selected_app()
-                        self.page = "list"
                     except OSError as e:
                         log(f'Delete failed: App {self.app_list[self.current_index]['appName']} not found')
+                    else:
+                        # The files are gone, so the index is rebuilt even if the NVM cleanup fails
+                        try:
+                            nvm_free_prefix(nvm_app_prefix(self.app_list[self.current_index]["folderName"]))
+                            forget_app("/apps/" + self.app_list[self.current_index]["folderName"])
+                        except Exception as e:
+                            log(f"Delete: NVM cleanup failed: {repr(e)}")
+                        build_app_index()
+                        self.page = "list"
                 elif btn == evt.BTN_C_DOWNUP:
                     pass
                 elif btn == evt.BTN_D_DOWNUP:
                     log(f"Installing app {self.app_list[self.current_index]['appName']}")
                     self.draw_msg(f"Installing app {self.app_list[self.current_index]['appName']}")
                     self.install_selected_app()
+                    build_app_index()
                     self.page = "list"
 
             self.draw_menu()
@@ -1,5 +1,4 @@
 import board
-import keypad
 import displayio
 import terminalio
 import wifi
@@ -16,6 +15,7 @@ import audiocore
 from badge.neopixels import NP
 from time import sleep
 from apps.baidge.badgemic import BadgeMic
+from badge.buttons import KEYS
 from badge.screens import EPD
 from badge.screens import round_button
 from adafruit_display_text.label import Label
@@ -70,15 +70,8 @@ class BaidgeApp:
         self.automation_url = automation_url
         self.button_state = [0,0,0,0]
         self_active_button = -1
-        self.buttons = keypad.Keys((
-            board.BTN1,
-            board.BTN2,
-            board.BTN3,
-            board.BTN4,
-        ), value_when_pressed=False)
-    
-    def __del__(self):
-        self.buttons.deinit()
+        # Shared with badge.buttons, key numbers are the same
+        self.buttons = KEYS
     
     def get_button(self,number):
         if number not in [0,1,2,3]:
@@ -18,6 +18,7 @@ from badge.constants import BB_HEIGHT
 from badge.constants import BB_WIDTH
 from badge.screens import *
 from badge.events import ANY_BTN_PRESSED, ANY_BTN_RELEASED
+from badge.launcher import exit_app
 from badge.log import log
 from badge.neopixels import NP as PIXELS
 from badge.neopixels import neopixels_off, set_neopixel, neopixel_reinit
@@ -152,6 +153,10 @@ def fail_screen(elapsed, answer_button, button_pressed):
 
 RACE_START_TIME = None  # None or a ticks_ms() value.
 
+# Every press and release, with its own data, even while play() is busy
+PRESSES = ANY_BTN_PRESSED.subscribe()
+RELEASES = ANY_BTN_RELEASED.subscribe()
+
 
 def hit_the_lights():
     rc = RainbowChase(PIXELS, speed=0.075, size=3, spacing=5, step=32)
@@ -186,13 +191,14 @@ async def play():
     # Start the lights in the background. This allows receipt of button press
     # to show "too soon" when user pressed button before light goes on.
 
+    PRESSES.clear()
     xmas_tree_task = asyncio.create_task(xmas_tree(answer_button))
 
     # Wait for keypress
-    await ANY_BTN_PRESSED.wait()
+    _, pressed = await PRESSES.get()
     xmas_tree_task.cancel()
 
-    button_pressed = ANY_BTN_PRESSED.data["name"]
+    button_pressed = pressed["name"]
     stop_msecs = supervisor.ticks_ms()
     neopixels_off()
 
@@ -209,10 +215,10 @@ async def play():
     keep_playing = True
 
     while True:
-        await ANY_BTN_PRESSED.wait()
-        b_pressed = ANY_BTN_PRESSED.data["name"]
-        await ANY_BTN_RELEASED.wait()
-        b_released = ANY_BTN_PRESSED.data["name"]
+        pressed_at, pressed = await PRESSES.get()
+        b_pressed = pressed["name"]
+        _, released = await RELEASES.get_since(pressed_at)
+        b_released = released["name"]
         if b_pressed != b_released:
             continue
         button = b_pressed
@@ -230,11 +236,12 @@ async def main():
     neopixels_off()
     _ = badge.buttons.start_tasks(interval=0.001)
     welcome_screen()
-    await ANY_BTN_RELEASED.wait()
+    RELEASES.clear()
+    await RELEASES.get()
     keep_playing = True
     while keep_playing:
         keep_playing = await play()
-    supervisor.reload()
+    exit_app()
 
 
 try:
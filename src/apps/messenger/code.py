@@ -36,6 +36,10 @@ EPD_DISP_W = EPD.width
 LCD_DISP_H = LCD.height
 LCD_DISP_W = LCD.width
 
+# Every press and release, with its own data, even while the app is busy
+PRESSES = ANY_BTN_PRESSED.subscribe()
+RELEASES = ANY_BTN_RELEASED.subscribe()
+
 character_set = ' ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 
 @on(badge.events.BTN_A_PRESSED)
@@ -222,10 +226,10 @@ class Messenger:
     async def handleButtons(self):
         print("Handling Buttons")
         while True:
-            await ANY_BTN_PRESSED.wait()
-            b_pressed = ANY_BTN_PRESSED.data["name"]
-            await ANY_BTN_RELEASED.wait()
-            b_released = ANY_BTN_PRESSED.data["name"]
+            pressed_at, pressed = await PRESSES.get()
+            b_pressed = pressed["name"]
+            _, released = await RELEASES.get_since(pressed_at)
+            b_released = released["name"]
             if b_pressed != b_released:
                 return
             button = b_pressed 
@@ -280,10 +284,10 @@ async def main():
     keep_playing = True
     neopixels_off()
     # Wait for keypress
-    await ANY_BTN_PRESSED.wait()
-    button_pressed = ANY_BTN_PRESSED.data["name"]
+    pressed_at, pressed = await PRESSES.get()
+    button_pressed = pressed["name"]
     print("Got button", button_pressed)
-    await ANY_BTN_RELEASED.wait()
+    await RELEASES.get_since(pressed_at)
     # stop_msecs = supervisor.ticks_ms()
     messenger_app.regular_screen()
     # elapsed = None
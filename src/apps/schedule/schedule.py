@@ -1,4 +1,4 @@
-import board, time, keypad
+import board, time
 import digitalio, terminalio
 from displayio import Group
 import adafruit_requests
@@ -11,6 +11,7 @@ from adafruit_display_text.scrolling_label import ScrollingLabel
 
 from adafruit_st7735r import ST7735R
 import badge.neopixels
+from badge.buttons import KEYS
 from badge.wifi import WIFI
 from badge.constants import EPD_SMALL, EPD_WIDTH, EPD_HEIGHT, LCD_WIDTH, WHITE, BLACK
 from badge.log import log
@@ -363,12 +364,8 @@ class ScheduleApp:
         self.sched_endpoint = f"{base_endpoint}badge/schedule"
         self.sched_time_endpoint = f"{base_endpoint}badge/schedule_time"
 
-        self.buttons = keypad.Keys((
-            board.BTN1,
-            board.BTN2,
-            board.BTN3,
-            board.BTN4,
-        ), value_when_pressed=False)
+        # Shared with badge.buttons, key numbers are the same
+        self.buttons = KEYS
 
     # Handle response codes from server
     def _handle_resp(self, resp) -> {}:
@@ -1,8 +1,9 @@
-import array,board,time,keypad,math
+import array,board,time,math
 import displayio,terminalio
 from displayio import Group
 from displayio import TileGrid
 from adafruit_display_text import label
+from badge.buttons import KEYS
 from badge.screens import EPD
 from badge.screens import LCD
 from badge.screens import center_text_x_plane
@@ -30,17 +31,10 @@ class SequencerApp:
     def __init__(self,lcd: LCD,epd: EPD):
         self.lcd = lcd
         self.epd = epd
-        self.buttons = keypad.Keys((
-            board.BTN1,
-            board.BTN2,
-            board.BTN3,
-            board.BTN4,
-        ),value_when_pressed=False)
+        # Shared with badge.buttons, key numbers are the same
+        self.buttons = KEYS
         self.dac_state = 0
 
-    def __del__(self):
-        self.buttons.deinit()
-
     def setup(self):
         pass
 
@@ -10,7 +10,9 @@ from supervisor import ticks_ms
 from badge.constants import LCD_WIDTH, LCD_HEIGHT, EPD_SMALL
 from badge.screens import LCD, EPD, center_text_x_plane
 from badge.neopixels import NP
+from badge_nvm import nvm_app_key
 from badge_nvm import nvm_open
+from badge_nvm import nvm_save
 from badge.buttons import a_pressed, b_pressed, c_pressed, d_pressed
 from leaderboard import post_to_leaderboard
 
@@ -18,6 +20,8 @@ TICKS_PERIOD = const(1<<29)
 TICKS_MAX = const(TICKS_PERIOD-1)
 TICKS_HALFPERIOD = const(TICKS_PERIOD//2)
 
+HIGHSCORE_KEY = nvm_app_key("/apps/totris", "highscore")
+
 def ticks_diff(ticks1, ticks2):
     "Compute the signed difference between two ticks values, assuming that they are within 2**28 ticks"
     diff = (ticks1 - ticks2) & TICKS_MAX
@@ -142,10 +146,17 @@ class Totris:
                     self.game_grid[tot.y+i][tot.x+j] = tot.color
 
     def get_highscore(self):
+        try:
+            return nvm_open(HIGHSCORE_KEY)["score"]
+        except ValueError:
+            pass
+        # Older badges keyed the high score by the app's display name
         with open("/apps/totris/metadata.json", "r") as f:
             meta = json.load(f)
             try:
-                nvm = json.loads(nvm_open(meta["app_name"]))
+                nvm = nvm_open(meta["app_name"])
+                if isinstance(nvm, str):
+                    nvm = json.loads(nvm)
                 return nvm["score"]
             except ValueError as e:
                 return 0
@@ -392,6 +403,8 @@ class Totris:
             game_over_area.background_color = 0x000000
             LCD.root_group.append(game_over_area)
             time.sleep(3)
+            if self.game_score > self.get_highscore():
+                nvm_save(HIGHSCORE_KEY, {"score": self.game_score})
             post_to_leaderboard(self.game_score)
 
     def multi_player_game(self):
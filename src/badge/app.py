@@ -1,95 +1,226 @@
 import json
 import os
+from binascii import crc32
 
 from .fileops import is_dir, is_file
 from .log import log
+from badge.constants import APP_ORDER
 from badge.constants import DEFAULT_CONFIG
 from badge.constants import LOADED_APP
+from badge.constants import ORDER_FREQUENCY
+from badge.constants import ORDER_MRU
 
 APPS_DIR = "/apps"
 DEFAULT_ICON = "/badge/img/app-default.bmp"
 
 
-class App:
-    def __init__(self, appdir):
-        self.appdir = appdir
+APP_INDEX = f"{APPS_DIR}/.index"
+APP_INDEX_VERSION = 3
+
+# Built on the host by tools/build_icon_atlas.py
+ICON_ATLAS = f"{APPS_DIR}/.atlas.bmp"
+ICON_ATLAS_MAP = f"{APPS_DIR}/.atlas.json"
+
+###############################################################################
+# The launcher lists apps from APP_INDEX instead of stat'ing and parsing every
+# app on each boot. The index holds one record per app with its resolved
+# code/icon paths, parsed metadata.json and boot.json, and is trusted as long
+# as the names in APPS_DIR and the size and mtime of APPS_DIR still match.
+# The launcher can't save it with root read only, so tools/build_app_index.py
+# writes it when deploying, without the size and mtime, which only the badge
+# knows. The App Store rebuilds it after installing or deleting an app. Edits
+# made inside an app over USB are picked up once the index is deleted.
+#
+# ICON_ATLAS holds every icon as one tile of a single bitmap, so the launcher
+# can change apps by changing a tile index. An app only gets a tile when the
+# atlas was built from an icon.bmp with the same crc32 as the one it has now,
+# taken when the app is indexed; anything else, e.g. an app installed by the
+# App Store since, keeps loading its own icon.
+
+
+def file_crc(path):
+    """crc32 of a file, read a little at a time."""
+    crc = 0
+    buf = bytearray(512)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                return crc
+            crc = crc32(view[:count], crc)
+
+
+def scan_app(appdir):
+    """Build the index record for one app directory."""
+    code_file = f"{appdir}/code.py"
+    icon_file = f"{appdir}/icon.bmp"
+    metadata_file = f"{appdir}/metadata.json"
+    record = {
+        "dir": appdir,
+        "code": code_file if is_file(code_file) else None,
+        "icon": icon_file if is_file(icon_file) else DEFAULT_ICON,
+        "icon_crc": None,
+        "meta": None,
+        "boot": None,
+    }
+    if record["icon"] != DEFAULT_ICON:
+        record["icon_crc"] = file_crc(icon_file)
+    try:
+        with open(metadata_file) as f:
+            record["meta"] = json.load(f)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(f"{appdir}/boot.json") as f:
+            record["boot"] = json.load(f)
+    except (OSError, ValueError):
+        pass
+    return record
 
-    @property
-    def code_file(self):
-        code_file = f"{self.appdir}/code.py"
-        if not is_file(code_file):
-            return None
-        return code_file
 
-    @property
-    def icon_file(self):
-        icon_file = f"{self.appdir}/icon.bmp"
-        if not is_file(icon_file):
-            icon_file = DEFAULT_ICON
-        return icon_file
+class App:
+    # Everything about the app is read once, here or from the app index,
+    # so the launcher can page through apps without touching the filesystem
+    __slots__ = ("appdir", "app_name", "code_file", "icon_file", "icon_tile", "_meta", "_boot_config")
+
+    def __init__(self, appdir, record=None, icon_tile=None):
+        if record is None:
+            record = scan_app(appdir)
+        self.appdir = appdir
+        self.app_name = appdir.split('/')[::-1][0]
+        self.code_file = record["code"]
+        self.icon_file = record["icon"]
+        self.icon_tile = icon_tile  # Index in ICON_ATLAS, or None
+        self._meta = record["meta"]
+
+        # DEFAULT_CONFIG is shared, so build a new dict instead of updating it
+        config = dict(DEFAULT_CONFIG)
+        config[LOADED_APP] = appdir
+        if record["boot"]:
+            config.update(record["boot"])
+        self._boot_config = config
 
     @property
     def metadata_file(self):
-        metadata_file_path = f"{self.appdir}/metadata.json"
-        if not is_file(metadata_file_path):
+        if self._meta is None:
             return None
-        return metadata_file_path
+        return f"{self.appdir}/metadata.json"
 
     @property
     def metadata_json(self):
-        metadata_file_path = self.metadata_file
-        if not metadata_file_path:
+        if self._meta is None:
             raise Exception("Metadata file not found")
-        with open(metadata_file_path) as f:
-            metadata = json.load(f)
-
-        return metadata
+        return self._meta
 
     @property
-    def boot_config(self):
-        boot_json_file = f"{self.appdir}/boot.json"
-        new_config = DEFAULT_CONFIG
-        new_config[LOADED_APP] = self.appdir
-        config = None
-        try:
-            config = json.load(open(boot_json_file, "r"))
-        except Exception:
-            # log(f"App.boot_config err\n{repr(e)}")
-            pass
-        
-        if config:
-            new_config.update(config)
-
-        return new_config
+    def in_process(self):
+        """metadata.json says the app can run inside the launcher's
+        interpreter: it ends with badge.launcher.exit_app() or by returning,
+        not by reloading."""
+        return bool(self._meta and self._meta.get("in_process"))
 
     @property
-    def app_name(self):
-        return self.appdir.split('/')[::-1][0]
+    def boot_config(self):
+        """A copy, so the caller may change it without touching the App."""
+        return dict(self._boot_config)
 
     def __repr__(self):
-        s = f"App({self.code_file},icon={self.icon_file})"
-        if self.boot_config:
-            s += ",boot_config=True"
-        return s
+        return f"App({self.code_file},icon={self.icon_file},boot_config=True)"
+
+
+def _app_names():
+    # Hide an app by renaming it's directory to start with '_'
+    # XXX: hack for dev
+    # Sorted, so an index written on the host lists them the same way
+    return sorted(e for e in os.listdir(APPS_DIR) if not e.startswith("_") and not e.startswith("."))
+
+
+def _apps_dir_stamp():
+    stat = os.stat(APPS_DIR)
+    return [stat[6], stat[8]]  # size, mtime
+
+
+def load_app_index(names):
+    """Return the records in APP_INDEX, or None if it is missing or stale."""
+    try:
+        with open(APP_INDEX) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != APP_INDEX_VERSION or index.get("names") != names:
+        return None
+    # None when written on the host
+    if index.get("stamp") is not None and index["stamp"] != _apps_dir_stamp():
+        return None
+    return index["apps"]
+
+
+def build_app_index(names=None):
+    """Scan every app and write APP_INDEX. Returns the records even if the
+    filesystem is read only and the index could not be saved."""
+    if names is None:
+        names = _app_names()
+    records = [scan_app(f"{APPS_DIR}/{e}") for e in names if is_dir(f"{APPS_DIR}/{e}")]
+    try:
+        with open(APP_INDEX, "w") as f:
+            json.dump({"version": APP_INDEX_VERSION, "names": names, "stamp": _apps_dir_stamp(), "apps": records}, f)
+    except OSError as e:
+        log(f"build_app_index:> Could not save {APP_INDEX}: {repr(e)}")
+    return records
+
+
+def load_icon_atlas():
+    """Return the ICON_ATLAS map, or None if there is no atlas."""
+    if not is_file(ICON_ATLAS):
+        return None
+    try:
+        with open(ICON_ATLAS_MAP) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _icon_tile(atlas, record):
+    if atlas is None:
+        return None
+    if record["icon"] == DEFAULT_ICON:
+        return atlas.get("default")
+    tile = atlas["tiles"].get(record["dir"].split('/')[-1])
+    if tile is None or tile[1] != record.get("icon_crc"):
+        return None
+    return tile[0]
 
 
 def get_app_list():
-    entries = list()
     if not is_dir(APPS_DIR):
         log("APPS_DIR not directory")
-        return entries
-    for e in os.listdir(APPS_DIR):
-        # Hide an app by renaming it's directory to start with '_'
-        # XXX: hack for dev
-        if e.startswith("_"):
-            continue
-        app_path = f"{APPS_DIR}/{e}"
-        if is_dir(app_path):
-            app = App(app_path)
-            entries.append(app)
-    return entries
-
-
-# APPLIST = [App(c, icon_file=i) for c, i in discover_app_files()]
-APPLIST = get_app_list()
-# log("badge.apps", APPLIST)
+        return list()
+    names = _app_names()
+    records = load_app_index(names)
+    if records is None:
+        records = build_app_index(names)
+    atlas = load_icon_atlas()
+    return [App(record["dir"], record, _icon_tile(atlas, record)) for record in records]
+
+
+def _sort_group(app):
+    meta = app._meta or {}
+    return {"+": 0, "-": 2}.get(meta.get("sort"), 1)
+
+
+def rank_apps(apps, usage=None, order=APP_ORDER):
+    """Order apps for the launcher. usage is the APP_USAGE record kept by
+    badge.launcher, mapping each appdir to [launch count, launch number of
+    its last launch]."""
+    used = (usage or {}).get("apps", {})
+
+    def key(app):
+        count, last = used.get(app.appdir, (0, 0))
+        if order == ORDER_MRU:
+            return (-last, _sort_group(app), app.app_name)
+        if order == ORDER_FREQUENCY:
+            return (-count, -last, _sort_group(app), app.app_name)
+        return (_sort_group(app), app.app_name)
+
+    return sorted(apps, key=key)
@@ -1,8 +1,6 @@
 import asyncio
 import board
-from digitalio import DigitalInOut
-from digitalio import Direction
-from digitalio import Pull
+import keypad
 
 from .events import (  # ALL_BTNS_SETTLED,;
     ANY_BTN_DOWNUP,
@@ -20,111 +18,113 @@ from .events import (  # ALL_BTNS_SETTLED,;
     BTN_D_DOWNUP,
     BTN_D_PRESSED,
     BTN_D_RELEASED,
-    any_event,
     event_sequence,
 )
+from .log import log
+
+# All four buttons are scanned by one keypad.Keys, which debounces them in
+# the background and timestamps every change. poll() turns what it queued
+# into the BTN_* and ANY_BTN_* events, with {"name", "timestamp"} as data.
+# Async code runs it from a single scan() task, sync code calls poll() or
+# a_pressed() and friends. Apps that read key events themselves use KEYS, key
+# numbers follow KEY_PINS, instead of claiming the pins with their own Keys.
+
+KEY_PINS = (board.BTN1, board.BTN2, board.BTN3, board.BTN4)
+KEYS = keypad.Keys(KEY_PINS, value_when_pressed=False, pull=True)
+SCAN_INTERVAL = 0.02
+
 
 class Button:
-    def __init__(self, name, press_event, release_event, getstate_func):
+    def __init__(self, name, key_number, press_event, release_event):
         self.name = name
-        self.getstate_func = getstate_func
-        self.current_state = getstate_func()
-        self.unpressed_state = self.current_state
+        self.key_number = key_number
+        self.pressed = False
         self.press_event = press_event
         self.release_event = release_event
 
     def __repr__(self):
         return f"Button({self.name})"
 
-    def _produce_events(self):
-        new = self.getstate_func()
+    def _produce_events(self, pressed, timestamp):
+        self.pressed = pressed
+        data = {"name" : self.name, "timestamp" : timestamp}
+        if pressed:
+            self.press_event.fire(data)
+            ANY_BTN_PRESSED.fire(data=data)
+        else:
+            self.release_event.fire(data)
+            ANY_BTN_RELEASED.fire(data=data)
 
-        # Didn't change, it's unpressed, so do nothing
-        if new == self.current_state:
-            return None
 
-        # Changed to unpressed, trigger release event
-        if new == self.unpressed_state:
-            self.release_event.fire()
-            ANY_BTN_RELEASED.fire(data={"name" : self.name})
-        #  Changed to pressed, trigger pressed event
-        else:
-            self.press_event.fire()
-            ANY_BTN_PRESSED.fire(data={"name" : self.name})
-        # Update current state
-        self.current_state = new
+BTN_A = Button("A", 3, BTN_A_PRESSED, BTN_A_RELEASED)
+BTN_B = Button("B", 2, BTN_B_PRESSED, BTN_B_RELEASED)
+BTN_C = Button("C", 1, BTN_C_PRESSED, BTN_C_RELEASED)
+BTN_D = Button("D", 0, BTN_D_PRESSED, BTN_D_RELEASED)
 
-    async def run(self, interval=0.0):
-        while True:
-            self._produce_events()
-            await asyncio.sleep(interval)  # human speed
+BUTTONS = [BTN_A, BTN_B, BTN_C, BTN_D]
+_BY_KEY = {b.key_number : b for b in BUTTONS}
+_EVENT = keypad.Event()
 
 
-button_pins = [board.BTN1, board.BTN2, board.BTN3, board.BTN4]
-buttons = []
-if hasattr(board, "BOOT"):
-    button_pins.append(board.BOOT)
+def poll():
+    """Fire the events for every key change KEYS has queued."""
+    if KEYS.events.overflowed:
+        KEYS.events.overflowed = False
+        log("buttons.poll:> Key event queue overflowed, presses were lost")
+    while KEYS.events.get_into(_EVENT):
+        _BY_KEY[_EVENT.key_number]._produce_events(_EVENT.pressed, _EVENT.timestamp)
 
-for pin in button_pins:
-    switch = DigitalInOut(pin)
-    switch.direction = Direction.INPUT
-    switch.pull = Pull.UP
-    buttons.append(switch)
 
 def a_pressed():
-    return not buttons[3].value
+    poll()
+    return BTN_A.pressed
 
 
 def b_pressed():
-    return not buttons[2].value
+    poll()
+    return BTN_B.pressed
 
 
 def c_pressed():
-    return not buttons[1].value
+    poll()
+    return BTN_C.pressed
 
 
 def d_pressed():
-    return not buttons[0].value
-
+    poll()
+    return BTN_D.pressed
 
-BTN_A = Button("A", BTN_A_PRESSED, BTN_A_RELEASED, a_pressed)
-BTN_B = Button("B", BTN_B_PRESSED, BTN_B_RELEASED, b_pressed)
-BTN_C = Button("C", BTN_C_PRESSED, BTN_C_RELEASED, c_pressed)
-BTN_D = Button("D", BTN_D_PRESSED, BTN_D_RELEASED, d_pressed)
 
-BUTTONS = [BTN_A, BTN_B, BTN_C, BTN_D]
+async def scan(interval=SCAN_INTERVAL):
+    # keypad keeps the timing, so interval only sets how soon events fire
+    while True:
+        poll()
+        await asyncio.sleep(interval)
 
 
-def start_tasks(interval=0.0):
-    t = [asyncio.create_task(b.run(interval)) for b in BUTTONS]
+def start_tasks(interval=SCAN_INTERVAL):
+    t = [asyncio.create_task(scan(interval))]
     return t
 
 
-def get_tasks(interval=0.0):
-    t = [ b.run(interval) for b in BUTTONS ]
+def get_tasks(interval=SCAN_INTERVAL):
+    t = [scan(interval)]
     return t 
 
 # These fire when the same button gets pressed and released
 def get_downup_tasks(interval=0.0):
 
-    # _f is a coro
-    async def _loop(_f, *args, **kwargs):
+    async def _downup(pressed, released, downup):
         while True:
-            output = await _f(*args, **kwargs)
-
-    downup_single_buttons = [
-        _loop(event_sequence,[BTN_A_PRESSED, BTN_A_RELEASED], BTN_A_DOWNUP),
-        _loop(event_sequence,[BTN_B_PRESSED, BTN_B_RELEASED], BTN_B_DOWNUP),
-        _loop(event_sequence,[BTN_C_PRESSED, BTN_C_RELEASED], BTN_C_DOWNUP),
-        _loop(event_sequence,[BTN_D_PRESSED, BTN_D_RELEASED], BTN_D_DOWNUP)
+            await event_sequence([pressed, released], downup)
+            ANY_BTN_DOWNUP.fire(data={ "event" : downup })
+
+    return [
+        _downup(BTN_A_PRESSED, BTN_A_RELEASED, BTN_A_DOWNUP),
+        _downup(BTN_B_PRESSED, BTN_B_RELEASED, BTN_B_DOWNUP),
+        _downup(BTN_C_PRESSED, BTN_C_RELEASED, BTN_C_DOWNUP),
+        _downup(BTN_D_PRESSED, BTN_D_RELEASED, BTN_D_DOWNUP)
     ]
-    
-    downup_any_button = _loop(any_event,
-        [ BTN_A_DOWNUP, BTN_B_DOWNUP, BTN_C_DOWNUP, BTN_D_DOWNUP ],
-        ANY_BTN_DOWNUP
-    )
-
-    return downup_single_buttons + [ downup_any_button]
 
 
 def start_downup_tasks(interval=0.0):
@@ -133,8 +133,14 @@ def start_downup_tasks(interval=0.0):
 
 # await this to get the next button pressed
 async def any_button_downup():
-    await ANY_BTN_DOWNUP.wait()
-    return ANY_BTN_DOWNUP.data.get("event", None)
+    # Only downups from this call on count, as with wait(). The queue keeps
+    # the data of the one that woke us even if another fires before we run
+    downups = ANY_BTN_DOWNUP.subscribe()
+    try:
+        _, data = await downups.get()
+    finally:
+        ANY_BTN_DOWNUP.unsubscribe(downups)
+    return data.get("event", None)
 
 def all_tasks(interval=0.0):
     return start_tasks() + start_downup_tasks()
@@ -39,6 +39,15 @@ SITE_BLUE = 0x3453FF
 # MISC
 LOADED_APP = 'loaded_app'
 BOOT_CONFIG = 'config'
+APP_USAGE = 'usage'
+
+# How the launcher orders apps: most recently used, most often used, or by
+# the "sort" field of metadata.json ("+" first, "-" last). Apps that tie, or
+# were never launched, fall back to the "sort" order and then their name.
+ORDER_MRU = 'mru'
+ORDER_FREQUENCY = 'frequency'
+ORDER_SORT = 'sort'
+APP_ORDER = ORDER_MRU
 DEFAULT_CONFIG = {
     "mount_root_rw": False,
     "disable_usb_drive": False,
@@ -1,41 +1,142 @@
 """Event thing to run callbacks in asyncio loop"""
 import asyncio
+import time
 
 from .log import dbg, log
 
-_COROS = list()
 DEBUG = False
+QUEUE_SIZE = 8
+DISPATCH_QUEUE_SIZE = 32
+
+# @on handlers, by event. One dispatcher task takes every fire of an event
+# that has handlers off the _DISPATCH queue and calls just those handlers,
+# timing each into _STATS: func -> [calls, total ns, longest ns].
+_HANDLERS = dict()
+_STATS = dict()
 
 def start_tasks():
-    return [asyncio.create_task(t) for t in _COROS]
+    return [asyncio.create_task(_dispatch())] if _HANDLERS else []
+
+
+def reset():
+    """Drop every @on handler and whatever is waiting on this module's events,
+    so another app can run in the same interpreter. Call it together with
+    asyncio.new_event_loop()."""
+    global _DISPATCH
+    _HANDLERS.clear()
+    _STATS.clear()
+    # A new queue, its asyncio.Event is bound to the old loop
+    _DISPATCH = EventQueue(DISPATCH_QUEUE_SIZE)
+    for value in globals().values():
+        if isinstance(value, Event):
+            value._event = asyncio.Event()
+            value._queues = []
 
 
 def on(evt):
     """Decorator that takes an event as an argument. This is a convenience
-    decorator. It creates a coroutine from the input function, then adds it
-    to the TASKS module global, which is used in the asyncio run loop.
-    The task is a wrapper around the input function that simply waits for
-    the event given as an argument to the decorator.
+    decorator. It adds the input function to the handlers of the event,
+    which the dispatcher task from start_tasks() calls every time the event
+    is fired, in the order they were added.
     Callbacks should take a single argument, the event. Events may have
     extra data added to them, which will be available in the callback.
     """
-    global _COROS
 
     def outer(func):
-        async def _task():
-            while True:
-                await evt.wait()
-                DEBUG and dbg("on-event", evt)
-                ret = func(evt)
-                DEBUG and dbg("on-event", evt, "ret=", ret)
-
-        _COROS.append(_task())
+        _HANDLERS.setdefault(evt, []).append(func)
+        _STATS[func] = [0, 0, 0]
 
         return func  # return original function here instead of wrapped one
 
     return outer
 
 
+async def _dispatch():
+    while True:
+        _, evt, data = await _DISPATCH.get()
+        # Handlers don't await, so evt.data is this fire's data while they run
+        evt.data = data
+        for func in _HANDLERS.get(evt, ()):
+            DEBUG and dbg("on-event", evt)
+            start = time.monotonic_ns()
+            try:
+                ret = func(evt)
+            finally:
+                took = time.monotonic_ns() - start
+                stats = _STATS[func]
+                stats[0] += 1
+                stats[1] += took
+                stats[2] = max(stats[2], took)
+            DEBUG and dbg("on-event", evt, "ret=", ret)
+
+
+def handler_stats():
+    """{handler name: (calls, total ms, longest ms)} for every @on handler."""
+    return {func.__name__ : (calls, total / 1_000_000, longest / 1_000_000)
+            for func, (calls, total, longest) in _STATS.items()}
+
+
+def dispatch_dropped():
+    """Fires lost because handlers fell DISPATCH_QUEUE_SIZE fires behind."""
+    return _DISPATCH.dropped
+
+
+class EventQueue:
+    """What one subscriber hasn't handled yet of an Event's fires, as
+    (timestamp in ms, data) records, (timestamp, event, data) for the
+    dispatcher. When it is full the oldest record is dropped and counted in
+    `dropped`."""
+
+    def __init__(self, size=QUEUE_SIZE):
+        self._records = [None] * size
+        self._head = 0
+        self._count = 0
+        self._ready = asyncio.Event()
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, record):
+        size = len(self._records)
+        if self._count == size:
+            self._head = (self._head + 1) % size
+            self._count -= 1
+            self.dropped += 1
+        self._records[(self._head + self._count) % size] = record
+        self._count += 1
+        self._ready.set()
+
+    def get_nowait(self):
+        """The oldest record, or None if there is none."""
+        if not self._count:
+            return None
+        record = self._records[self._head]
+        self._records[self._head] = None
+        self._head = (self._head + 1) % len(self._records)
+        self._count -= 1
+        return record
+
+    async def get(self):
+        """Wait for and return the oldest record."""
+        while not self._count:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get_nowait()
+
+    async def get_since(self, timestamp):
+        """Wait for the oldest record fired at or after timestamp, dropping
+        any older ones, e.g. the release that goes with a press."""
+        while True:
+            record = await self.get()
+            if record[0] >= timestamp:
+                return record
+
+    def clear(self):
+        while self.get_nowait():
+            pass
+
+
 class Event:
     """A lightweight wrapper around an asyncio.event . Event producers
     call fire(), and user of the above decorator use @on(<event>) to set up
@@ -49,27 +150,57 @@ class Event:
         self._name = name
         self._event = asyncio.Event()
         self._kwargs = kwargs
+        self._queues = []
         self.data = dict()
 
     def fire(self, data=None):
         DEBUG and dbg("fire",repr(self),repr(data))
         if data is None:
-            self.data = dict()
+            data = dict()
         self.data = data
+        timestamp = time.monotonic_ns() // 1_000_000
+        if self in _HANDLERS:
+            _DISPATCH.put((timestamp, self, data))
+        record = (timestamp, data)
+        for queue in self._queues:
+            queue.put(record)
         self._event.set()
         self._event.clear()
 
+    def subscribe(self, size=QUEUE_SIZE):
+        """Return an EventQueue that gets every fire from now on. Unlike
+        wait(), nothing is missed while the subscriber is busy, and each
+        record keeps its own data."""
+        queue = EventQueue(size)
+        self._queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._queues.remove(queue)
+
     def __repr__(self):
         return f"<{self._name}>"
 
     async def wait(self):
+        # Only wakes tasks already waiting and self.data may change before
+        # they run, use subscribe() to get every fire and its data.
         # XXX: add timeout
         return await self._event.wait()
 
+_DISPATCH = EventQueue(DISPATCH_QUEUE_SIZE)
+
 # Wait on a list of events, then fire output event
 async def event_sequence(input_events:list[Event], output_event:Event):
-    for evt in input_events:
-        await evt.wait()
+    # Subscribed up front so a later event that fires before the task gets
+    # to wait on it still counts
+    queues = [evt.subscribe() for evt in input_events]
+    try:
+        timestamp = 0
+        for queue in queues:
+            timestamp, _ = await queue.get_since(timestamp)
+    finally:
+        for evt, queue in zip(input_events, queues):
+            evt.unsubscribe(queue)
     output_event.fire()
 
 # Wait on a group of Events and output one event with the trigger
@@ -1,70 +1,373 @@
 import adafruit_imageload
+import asyncio
 import displayio
+import gc
+import sys
+import time
+from collections import OrderedDict
 from adafruit_bitmap_font.bitmap_font import load_font
+from adafruit_display_text.label import Label
 from adafruit_display_text.scrolling_label import ScrollingLabel
-from displayio import Group, TileGrid
+from displayio import Group
+from displayio import TileGrid
+from terminalio import FONT
 
+import badge.buttons
+import badge.events as evt
+from badge_nvm import nvm_compact_task
 from badge.app import App
-from badge.colors import SITE_BLUE
+from badge.app import ICON_ATLAS
+from badge.app import get_app_list
+from badge.app import rank_apps
+from badge.constants import BB_HEIGHT
+from badge.constants import BB_WIDTH
+from badge.constants import APP_ORDER
+from badge.constants import SITE_BLUE
+from badge.events import on
+from badge.launcher import launch_app
+from badge.launcher import nvm_read_usage
+from badge.log import log
+from badge.neopixels import set_neopixel, set_neopixels
+from badge.profile import flush
+from badge.profile import phase
 from badge.screens import EPD
 from badge.screens import LCD
-from badge.screens import clear_lcd_screen
-from badge.screens import clear_epd_screen
-from badge.screens import epd_round_button
-
-EPD_DISP_H = EPD.height
-EPD_DISP_W = EPD.width
-LCD_DISP_H = LCD.height
-LCD_DISP_W = LCD.width
+from badge.screens import center_text_x_plane
+from badge.screens import clear_screen
+from badge.screens import round_button
+from badge.ziplist import ziplist
+
+# The launcher menu. badge.launcher only imports this once it knows the menu
+# is going to be shown, so forwarding to an app never loads the display stack.
+
+#################### Globals ###############
+
+### Launcher ###
+SELECTO = None # Populate at show_menu()
+
+### Apps ###
+APPLIST = [] # Populate at show_menu()
+
+### UI ###
 ICON_H = 76
 ICON_W = 128
-FONT = load_font('font/font.pcf')
-
-
-def display_lcd_app_icon(app: App):
-  icon = app.icon_file
-  app_name = app.app_name
-  meta = app.metadata_json
-  text = f"{meta['app_name']}   Created By: {meta['author']}          "
-
-  clear_lcd_screen(LCD.root_group)
-
-  group = Group()  
-  background = displayio.Bitmap(128, 128, 1)
-  palette1 = displayio.Palette(1)
-  palette1[0] = SITE_RED
-  bitmap, palette2 = adafruit_imageload.load(icon,bitmap=displayio.Bitmap,palette=displayio.Palette)
-  tile_grid1 = TileGrid(background, pixel_shader=palette1)
-  tile_grid2 = TileGrid(bitmap, pixel_shader=palette2)
-  label = ScrollingLabel(font=FONT, text=text, max_characters=13, animate_time=0.2)
-  y = LCD_DISP_H-((LCD_DISP_H-ICON_H)//2)
-  label.x = 5
-  label.y = LCD_DISP_H-((LCD_DISP_H-ICON_H)//2)
-  LCD.root_group = group
-  group.append(tile_grid1)
-  group.append(tile_grid2)
-  group.append(label)
-
-  return label
-
-def draw_epd_launch_screen():
-  B1 = "S4 Next App"
-  B2 = "S7 Launch"
-  SUMMIT = "Offensive Summit 2024"
-  HEADER = "Select An App"
-  scale = 2
-  button_rad = 5
-  SUMMIT_x = (EPD_DISP_W //2) - (EPD._font.width(SUMMIT) // 2)
-  SUMMIT_y = 1
-  HEADER_x = (EPD_DISP_W //2) - ((EPD._font.width(HEADER) * scale) // 2)
-  HEADER_y = (EPD_DISP_H //2) - ((EPD._font.font_height * scale) // 2)
-  B1_x = 5 + button_rad
-  B1_y = EPD_DISP_H - 5 - button_rad - EPD._font.font_height
-  B2_x = EPD_DISP_W - 5 - button_rad - EPD._font.width(B2)
-  B2_y = EPD_DISP_H - 5 - button_rad - EPD._font.font_height
-  clear_epd_screen()
-  EPD.text(SUMMIT,SUMMIT_x,SUMMIT_y,1,size=1)
-  EPD.text(HEADER,HEADER_x,HEADER_y,1,size=scale)
-  epd_round_button(B1, B1_x, B1_y, 5)
-  epd_round_button(B2, B2_x, B2_y, 5)
-  EPD.draw()
+
+# Icons of the apps either side of the selected one are loaded into RAM once
+# the launcher has been idle for ICON_PREFETCH_IDLE seconds, keeping at most
+# ICON_CACHE_BYTES of them and never taking free memory below ICON_MIN_FREE.
+# adafruit_imageload makes a 16 bit Bitmap of a 24 bit BMP, which most icons
+# are, so the budget holds two of those
+ICON_CACHE_BYTES = 2 * ICON_W * ICON_H * 2
+ICON_MIN_FREE = 32 * 1024
+ICON_PREFETCH_IDLE = 0.5
+
+SCROLL_FONT = load_font('font/font.pcf')
+
+OFF, DIM, BRIGHT = (0, 0, 0), (0, 25, 25), (0, 106, 66)
+NEO_STATES = [OFF, DIM, BRIGHT]
+
+LAUNCHER_UI = None # Populated at show_menu()
+
+############### Button Events ##############
+
+@on(evt.BTN_A_PRESSED)
+def choose_next_app(event):
+    # on press, just light the light to indicate
+    # press received, but don't actually advance the
+    # selector until button release. not sure why, but
+    # feels like this is how it should work.
+    set_neopixel("a", 255)
+
+@on(evt.BTN_A_RELEASED)
+def a_released(event):
+    global LAUNCHER_UI
+    # turn it off
+    set_neopixel("a", 0)
+    # advance to next app
+    SELECTO.forward()
+    app, indicator = SELECTO.current()
+    vals = get_neo_update_vals(indicator)
+    set_neopixels(*vals)
+    LAUNCHER_UI.lcd_change_app(app)
+
+@on(evt.BTN_C_PRESSED)
+def c_pressed(event):
+    set_neopixel("c", 255)
+
+@on(evt.BTN_C_RELEASED)
+def c_released(event):
+    # turn it off
+    set_neopixel("c", 0)
+    sys.exit()
+
+@on(evt.BTN_D_PRESSED)
+def D_pressed(event):
+    set_neopixel("d", 255)
+
+@on(evt.BTN_D_RELEASED)
+def d_released(event):
+    set_neopixel("d", 0)
+    current = SELECTO.current()
+    entry = current[0]
+    log("app_launching", entry.code_file, type(entry.code_file), entry.appdir)
+    launch_app(entry)
+
+############## Launcher UI #################
+
+class LauncherUI:
+
+    root_group: Group
+    bitmap_group: Group
+    scroll_label_group: Group
+    hold_label: int
+    atlas_grid: TileGrid
+    cache_bmps: bool
+    bmps: {}
+    icon_cache: OrderedDict
+    icon_cache_bytes: int
+    icon_cache_budget: int
+    last_change: float
+    prefetch_tried: set
+
+    def __init__(self, cache_bmps=False, icon_cache_bytes=ICON_CACHE_BYTES):
+        self.cache_bmps = cache_bmps
+        self.atlas_grid = None
+        # app_name: (bitmap, palette, size), least recently used first. An
+        # OrderedDict since plain dicts on the badge don't keep that order.
+        # None marks an icon that could not be loaded
+        self.icon_cache = OrderedDict()
+        self.icon_cache_bytes = 0
+        self.icon_cache_budget = icon_cache_bytes
+        self.last_change = time.monotonic()
+        # Neighbours prefetch_icons() already tried for this selection
+        self.prefetch_tried = set()
+        # Select app
+        app, _ = SELECTO.current()
+
+        # Init LCD and EPD
+        self.root_group, self.bitmap_group, self.scroll_label_group = self.init_lcd(app)
+        LCD.root_group = self.root_group
+        self.hold_label = 0
+        self.init_epd()
+
+    def init_lcd(self, app: App):
+        """Create inital LCD display structure, with an initial app displayed"""
+        app_name = app.app_name
+        meta = app.metadata_json
+        text = f"{meta['app_name']}   Created By: {meta['author']}          "
+
+        clear_screen(LCD)
+
+        group = Group()  
+        
+        background = displayio.Bitmap(128, 128, 1)
+        background_palette = displayio.Palette(1)
+        background_palette[0] = SITE_BLUE
+        background_tile_grid = TileGrid(background, pixel_shader=background_palette)
+
+        # One OnDiskBitmap for every icon in the atlas, opened once
+        if any(entry.icon_tile is not None for entry in APPLIST):
+            try:
+                atlas = displayio.OnDiskBitmap(ICON_ATLAS)
+                self.atlas_grid = TileGrid(atlas, pixel_shader=atlas.pixel_shader, tile_width=ICON_W, tile_height=ICON_H)
+            except Exception as e:
+                log(f"init_lcd:> Not using {ICON_ATLAS}: {repr(e)}")
+
+        # Cache bitmaps the atlas doesn't have, this will take a while
+        if self.cache_bmps:
+            self.bmps = {}
+            for entry in APPLIST:
+                if self.atlas_grid is None or entry.icon_tile is None:
+                    self.bmps[entry.app_name] = adafruit_imageload.load(entry.icon_file,bitmap=displayio.Bitmap,palette=displayio.Palette)
+
+        bitmap_tile_grid = self.icon_tile_grid(app)
+        
+        scroll_label = ScrollingLabel(font=SCROLL_FONT, text=text, max_characters=13, animate_time=0, current_index=0)
+        scroll_label.x = 5
+        scroll_label.y = LCD.height-((LCD.height-ICON_H)//2)
+        
+        group.append(background_tile_grid)
+        group.append(bitmap_tile_grid)
+        group.append(scroll_label)
+        scroll_label.update(force=True)
+
+        return group, bitmap_tile_grid, scroll_label
+
+    def init_epd(self):
+        B1 = "S4 Next"
+        B2 = "S7 Run"
+        SUMMIT = "Offensive Summit"
+        HEADER = "Select An App"
+        scale = 1
+        button_rad = 5
+        splash = Group()
+
+        SUMMIT_lb = center_text_x_plane(EPD, SUMMIT)
+        HEADER_lb = center_text_x_plane(EPD, HEADER, scale=scale)
+        HEADER_lb.y = (EPD.height //2) - ((HEADER_lb.bounding_box[BB_HEIGHT] * scale) // 2)
+
+        B1_lb = Label(font=FONT,text=B1)
+        B1_x = button_rad
+        B1_y = EPD.height - button_rad - ((B1_lb.bounding_box[BB_HEIGHT]*scale)//2)
+
+        B2_lb = Label(font=FONT,text=B2)
+        B2_x = EPD.width - button_rad - B2_lb.bounding_box[BB_WIDTH]
+        B2_y = EPD.height - button_rad - ((B2_lb.bounding_box[BB_HEIGHT]*scale)//2)
+
+        clear_screen(EPD)
+        splash.append(SUMMIT_lb)
+        splash.append(HEADER_lb)
+        splash.append(round_button(B1_lb, B1_x, B1_y, 5))
+        splash.append(round_button(B2_lb, B2_x, B2_y, 5))
+        EPD.root_group = splash
+        EPD.refresh()
+
+    def icon_tile_grid(self, app: App):
+        """TileGrid showing the app's icon. With the atlas this only changes
+        the tile index, otherwise the icon is opened."""
+        if self.atlas_grid is not None and app.icon_tile is not None:
+            self.atlas_grid[0] = app.icon_tile
+            return self.atlas_grid
+
+        if self.cache_bmps:
+            bitmap, palette = self.bmps[app.app_name]
+        elif self.icon_cache.get(app.app_name):
+            # Most recently used goes last
+            entry = self.icon_cache.pop(app.app_name)
+            self.icon_cache[app.app_name] = entry
+            bitmap, palette, _ = entry
+        else:
+            bitmap = displayio.OnDiskBitmap(app.icon_file)
+            palette = bitmap.pixel_shader
+        return TileGrid(bitmap, pixel_shader=palette)
+
+    def lcd_change_app(self, app: APP):
+        app_name = app.app_name
+        meta = app.metadata_json
+
+        # A TileGrid's bitmap can only be replaced by one of the same size,
+        # so swap the whole TileGrid when moving to or from the atlas
+        tile_grid = self.icon_tile_grid(app)
+        if tile_grid is not self.bitmap_group:
+            self.root_group[self.root_group.index(self.bitmap_group)] = tile_grid
+            self.bitmap_group = tile_grid
+        self.last_change = time.monotonic()
+        self.prefetch_tried = set()
+
+        scroll_text = f"{meta['app_name']}   Created By: {meta['author']}          "
+        self.scroll_label_group.text = scroll_text
+        self.scroll_label_group.current_index = 0
+        self.hold_label = 0
+        LCD.refresh()
+
+    def needs_icon(self, app: App):
+        """True if showing the app would open its icon from flash."""
+        if self.cache_bmps or app.app_name in self.icon_cache:
+            return False
+        return self.atlas_grid is None or app.icon_tile is None
+
+    def cache_icon(self, app: App, keep=()):
+        """Load the app's icon into the LRU cache, evicting old icons to
+        stay within the budget. Icons of the apps named in `keep` are never
+        evicted, the icon isn't cached if that is the only way to fit it."""
+        gc.collect()
+        if gc.mem_free() < ICON_MIN_FREE:
+            return
+        try:
+            bitmap, palette = adafruit_imageload.load(app.icon_file, bitmap=displayio.Bitmap, palette=displayio.Palette)
+        except Exception as e:
+            log(f"cache_icon:> {app.icon_file}: {repr(e)}")
+            self.icon_cache[app.app_name] = None
+            return
+
+        # A Bitmap packs each pixel into 1, 2, 4, 8 or 16 bits
+        bits = 16
+        if isinstance(palette, displayio.Palette):
+            bits = 1
+            while 1 << bits < len(palette):
+                bits *= 2
+        size = bitmap.width * bitmap.height * bits // 8
+        if size > self.icon_cache_budget:
+            return
+
+        while self.icon_cache_bytes + size > self.icon_cache_budget:
+            oldest = next((name for name in self.icon_cache if name not in keep), None)
+            if oldest is None:
+                return
+            entry = self.icon_cache.pop(oldest)
+            if entry:
+                self.icon_cache_bytes -= entry[2]
+        self.icon_cache[app.app_name] = (bitmap, palette, size)
+        self.icon_cache_bytes += size
+
+    async def prefetch_icons(self, interval=0.1):
+        """Load the next or previous app's icon while the user is idle, one
+        per pass so button events are not held up for long. Once either is
+        cached, or both were tried, nothing more is loaded until the selection
+        changes, since every load blocks the event loop for a full decode."""
+        if not self.icon_cache_budget:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_change < ICON_PREFETCH_IDLE:
+                continue
+            neighbours = [SELECTO.peek(offset)[0].app_name for offset in (1, -1)]
+            if any(self.icon_cache.get(name) for name in neighbours):
+                continue
+            for offset in (1, -1):
+                app, _ = SELECTO.peek(offset)
+                if app.app_name not in self.prefetch_tried:
+                    self.prefetch_tried.add(app.app_name)
+                    if self.needs_icon(app):
+                        self.cache_icon(app, keep=neighbours)
+                    break
+
+    async def lcd_animate_label(self):
+        while True:
+            if self.hold_label < 5:
+                self.hold_label += 1
+            else:
+                self.scroll_label_group.update(force=True)
+            await asyncio.sleep(0.2)
+        
+    async def run(self):
+        button_tasks = badge.buttons.start_tasks(interval=0.05)
+        event_tasks = evt.start_tasks()
+        nvm_tasks = [asyncio.create_task(nvm_compact_task())]
+        ui_tasks = [asyncio.create_task(self.lcd_animate_label()), asyncio.create_task(self.prefetch_icons())]
+        all_tasks = ui_tasks + button_tasks + event_tasks + nvm_tasks
+        await asyncio.gather(*all_tasks)
+
+
+################## NEOPIXELS ###############
+
+def get_neo_update_vals(pattern):
+    ret = [NEO_STATES[i] for i in pattern]
+    return ret
+
+def indicators():
+    i = 0
+    while True:
+        base = (i // 4) % 2
+        val = [base] * 4
+        val[i%4] = base + 1
+        yield tuple(val)
+        i += 1
+
+################## MENU ####################
+
+def show_menu():
+    global SELECTO, APPLIST, LAUNCHER_UI
+    usage = nvm_read_usage()
+    APPLIST = rank_apps(get_app_list(), usage, usage.get("order", APP_ORDER))
+    phase("applist")
+
+    sel_entries = list(zip(APPLIST, indicators()))
+    SELECTO = ziplist(sel_entries)
+    if APPLIST:
+        set_neopixels(*get_neo_update_vals(sel_entries[0][1]))
+
+    LAUNCHER_UI = LauncherUI(cache_bmps=False)
+    phase("menu")
+    flush()
+    asyncio.run(LAUNCHER_UI.run())
@@ -1,4 +1,3 @@
-import asyncio
 import gc
 import time
 
@@ -9,6 +8,9 @@ nanos_per_ms = 1_000_000
 
 
 async def info(interval=1.0): # seconds
+    # Imported here, every module logs but few of them run this task
+    import asyncio
+
     ctr = 0
     interval_ns = interval * nanos_per_s
     while True:
@@ -0,0 +1,102 @@
+import gc
+import struct
+from time import monotonic_ns
+
+from badge.log import log
+
+###############################################################################
+# Boot and launch timing. phase("name") notes the time since power on and
+# gc.mem_free() in RAM, flush() adds the noted phases to a ring buffer kept in
+# NVM under PROFILE_KEY so they survive the reloads and resets between
+# boot.py, the launcher and the app. Nothing is written unless the ring buffer
+# was created with profile_enable().
+#
+# A phase taken earlier than the last one recorded means the badge was reset,
+# so it starts a new boot. Print the buffer over serial with dump() and render
+# it with tools/boot_timeline.py.
+#
+# badge_nvm is only imported when flushing, so a phase noted before it is
+# first imported leaves loading the NVM index out.
+
+PROFILE_KEY = "profile"
+PROFILE_ENTRIES = 24
+
+_HEADER = "<HHI"     # next entry, boot number, ms of the last entry
+_ENTRY = "<H8sII"    # boot number, phase name, ms since power on, gc.mem_free()
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_ENTRY_SIZE = struct.calcsize(_ENTRY)
+
+_pending = []
+
+
+def phase(name: str):
+    """Note that `name` (up to 8 characters) starts now."""
+    _pending.append((name, monotonic_ns() // 1_000_000, gc.mem_free()))
+
+
+def flush():
+    """Write the phases noted since the last flush to NVM."""
+    global _pending
+    from badge_nvm import nvm_open, nvm_save
+
+    pending, _pending = _pending, []
+    if not pending:
+        return
+    try:
+        ring = bytearray(nvm_open(PROFILE_KEY))
+    except ValueError:
+        return  # Profiling is off
+
+    entries = (len(ring) - _HEADER_SIZE) // _ENTRY_SIZE
+    next_entry, boot, last_ms = struct.unpack_from(_HEADER, ring)
+    for name, ms, mem_free in pending:
+        if ms < last_ms or boot == 0:
+            boot = boot % 0xFFFF + 1
+        struct.pack_into(_ENTRY, ring, _HEADER_SIZE + next_entry * _ENTRY_SIZE, boot, name.encode()[:8], ms, mem_free)
+        next_entry = (next_entry + 1) % entries
+        last_ms = ms
+    struct.pack_into(_HEADER, ring, 0, next_entry, boot, last_ms)
+
+    try:
+        nvm_save(PROFILE_KEY, bytes(ring))
+    except Exception as e:
+        log(f"profile.flush:> {repr(e)}")
+
+
+def profile_enable(entries: int = PROFILE_ENTRIES):
+    """Create an empty ring buffer of `entries` phases, which turns profiling on."""
+    from badge_nvm import nvm_save
+    nvm_save(PROFILE_KEY, bytes(_HEADER_SIZE + entries * _ENTRY_SIZE))
+
+
+def profile_disable():
+    """Drop the ring buffer, which turns profiling off."""
+    from badge_nvm import nvm_free
+    try:
+        nvm_free(PROFILE_KEY)
+    except ValueError:
+        pass
+
+
+def records():
+    """The recorded phases, oldest first, as (boot, name, ms, mem_free)."""
+    from badge_nvm import nvm_open
+    try:
+        ring = nvm_open(PROFILE_KEY)
+    except ValueError:
+        return []
+    entries = (len(ring) - _HEADER_SIZE) // _ENTRY_SIZE
+    next_entry = struct.unpack_from(_HEADER, ring)[0]
+    result = []
+    for i in range(entries):
+        offset = _HEADER_SIZE + (next_entry + i) % entries * _ENTRY_SIZE
+        boot, name, ms, mem_free = struct.unpack_from(_ENTRY, ring, offset)
+        if boot:
+            result.append((boot, name.rstrip(b"\0").decode(), ms, mem_free))
+    return result
+
+
+def dump():
+    """Print the recorded phases over serial for tools/boot_timeline.py."""
+    for boot, name, ms, mem_free in records():
+        print(f"profile:{boot},{name},{ms},{mem_free}")
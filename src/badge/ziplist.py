@@ -14,3 +14,7 @@ class ziplist:
 
     def backward(self):
         self._current = (self._current - 1) % len(self._list)
+
+    def peek(self, offset: int):
+        """The entry `offset` places away from the current one, without moving"""
+        return self._list[(self._current + offset) % len(self._list)]
@@ -1,3 +1,7 @@
+from badge.profile import flush
+from badge.profile import phase
+phase("boot")
+
 import board
 import digitalio
 import json
@@ -5,23 +9,34 @@ import microcontroller
 import storage
 import supervisor
 import os
+from badge_nvm import nvm_fsck
 from badge_nvm import nvm_open                                                                                     
 from time import sleep
-from badge.screens import EPD
-from badge.screens import LCD
-from badge.screens import center_text_x_plane
-from badge.screens import center_text_y_plane
-from badge.screens import clear_screen
 from badge.log import log
 from badge.constants import LOADED_APP
 from badge.constants import BOOT_CONFIG
 from badge.constants import DEFAULT_CONFIG
-from displayio import Group
-from terminalio import FONT
-from adafruit_display_text.label import Label
 
 #os.rename("boot_out.txt", "boot_out.txt.bak")
 
+# Only the token screens below draw anything, they import the display stack
+# themselves so a normal boot doesn't initialize both displays for nothing.
+
+def show_token_result(scale):
+    from adafruit_display_text.label import Label
+    from badge.screens import EPD
+    from badge.screens import center_text_x_plane
+    from badge.screens import center_text_y_plane
+    from badge.screens import clear_screen
+    from terminalio import FONT
+
+    nobody = center_text_y_plane(EPD, center_text_x_plane(EPD, Label(font=FONT, text='nobody', scale=scale)))
+    clear_screen(EPD)
+    EPD.root_group.append(nobody)
+    EPD.refresh()
+
+phase("imports")
+
 ###############################################################################
 
 # boot.py will process boot options from nvm
@@ -97,10 +112,7 @@ except ImportError as e:
   from get_token import get_token
   success = get_token()
   if success:
-    nobody = center_text_y_plane(EPD, center_text_x_plane(EPD, Label(font=FONT, text='nobody', scale=2)))
-    clear_screen(EPD)
-    EPD.root_group.append(nobody)
-    EPD.refresh()
+    show_token_result(2)
     while True:
       pass
 
@@ -112,10 +124,7 @@ if not BTN3.value and not BTN4.value:
   from get_token import get_token
   success = get_token()
   if success:
-    nobody = center_text_y_plane(EPD, center_text_x_plane(EPD, Label(font=FONT, text='nobody', scale=3)))
-    clear_screen(EPD)
-    EPD.root_group.append(nobody)
-    EPD.refresh()
+    show_token_result(3)
     while True:
       pass
 
@@ -124,15 +133,24 @@ if not BTN3.value and not BTN4.value:
 
 ###############################################################################
 
+# Slots that failed their check were dropped when the NVM index was loaded
+damaged = nvm_fsck(full=False)["damaged"]
+if damaged:
+    log(f"boot.py: Dropped damaged NVM entries: {damaged}")
+
 new_config = None
 
 try:
-    new_config = json.loads(nvm_open(BOOT_CONFIG))
+    new_config = nvm_open(BOOT_CONFIG)
+    # The launcher saves a JSON string, a dict may be left from an older build
+    if isinstance(new_config, str):
+        new_config = json.loads(new_config)
     log(f'Config read from NVM: {new_config}')
-except KeyError:
+except ValueError:
     log(f"boot.py: No config found")
 
-boot_config = DEFAULT_CONFIG
+phase("config")
+boot_config = dict(DEFAULT_CONFIG)
 
 if new_config is not None:
     boot_config.update(new_config)
@@ -155,6 +173,9 @@ if boot_config["mount_root_rw"]:
         log(repr(e))
 
 
+phase("mounted")
+flush()
+
 # next_code_file will be set by launcher,
 # then passed back after it hard boots with the updated
 # boot settings
@@ -1,3 +1,6 @@
+from badge.profile import phase
+phase("code.py")
+
 import supervisor
 from badge.launcher import run
 
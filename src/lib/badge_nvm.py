@@ -1,50 +1,136 @@
-__all__ = ["nvm_save", "nvm_open","nvm_free","nvm_compact","nvm_info","nvm_format()","nvm_wipe"]
+__all__ = ["nvm_save", "nvm_open","nvm_free","nvm_compact","nvm_info","nvm_format","nvm_wipe","nvm_batch","nvm_stats","nvm_compact_task",
+           "nvm_keys","nvm_free_prefix","nvm_app_key","nvm_app_prefix","nvm_set_quota","nvm_usage",
+           "nvm_size","nvm_open_into","nvm_reader","nvm_fsck"]
 
 import struct
 import json
 
+from collections import OrderedDict
+from time import monotonic_ns
+
+from binascii import crc32
 from memory_block import MemoryBlockListException
+from memory_block import _bisect
 from memory_block import _mbl
-from memory_block import _MemoryBlock
-from memory_block import _MemoryBlockList
 from Base64Wrapper import Base64Wrapper
+from nvm_codec import decode
+from nvm_codec import encode
+from nvm_codec import is_binary_type
+from nvm_codec import is_container_type
+from nvm_codec import payload_span
+from nvm_log import LOG_MAGIC
+from nvm_log import _LogNVM
 from badge.log import log
 from microcontroller import nvm as board_NVM
 
+###############################################################################
+# NVM layout
+#
+#   [0:9]                header  -> magic "slot:", version, slot size, slot count
+#   [9:_DATA_START]      index   -> fixed size slots, one per saved entry
+#   [_DATA_START:]       data    -> records of [name length][name][value]
+#
+# A slot holds the crc32 of the entry name, the start and stop of its record,
+# the data type, a crc32 of the record and a 16 bit check of the slot's own
+# fields. Saving or freeing an entry only rewrites the one slot that belongs
+# to it. A slot with a start of 0 is empty.
+#
+# At boot only the index is checked: a slot whose check or name hash does not
+# match is dropped on its own and every other entry is kept. Record crcs are
+# checked when an entry is read and by nvm_fsck(), so a damaged value is
+# dropped instead of being handed back.
+#
+# nvm_batch() writes all of its records to free space first, then a journal
+# record listing the new slots. Writing the journal's own slot is the commit
+# marker: once it is on NVM the new slots are copied into the index and the
+# journal slot is emptied. A journal slot found at boot is replayed, anything
+# written before it is simply unreferenced free space.
+#
+# The NVM can instead be formatted as a wear leveled log, see nvm_log. Both
+# stores have the same methods and whichever one the header names is opened.
+#
+# A save that finds no FREE block big enough compacts on the spot. The idle
+# compaction of nvm_compact_task() only starts once the largest FREE block is
+# under 1/COMPACT_FRAGMENTATION of the free space, so an entry that grows on
+# each save doesn't move every record after it in the background.
+
+NVM_MODE_SLOT = "slot"
+NVM_MODE_LOG = "log"
+
+_HEADER = "<5sBBH"
+_HEADER_MAGIC = b"slot:"
+_HEADER_VERSION = 2
+_LEGACY_MAGIC = b"size:"
+
+_SLOT_FIELDS = "<IHHBI"
+_SLOT = _SLOT_FIELDS + "H"  # the fields and their check
+_SLOT_SIZE = struct.calcsize(_SLOT)
+_SLOT_FIELDS_SIZE = struct.calcsize(_SLOT_FIELDS)
+_SLOT_CRC_OFFSET = struct.calcsize("<IHHB")
+
+_JOURNAL_NAME = ".journal"
+_JOURNAL_ENTRY = "<H"  # slot number, followed by the packed slot
+_JOURNAL_ENTRY_SIZE = struct.calcsize(_JOURNAL_ENTRY) + _SLOT_SIZE
+_JOURNAL_SLOT_OFFSET = struct.calcsize(_JOURNAL_ENTRY)
+_TYPE_JOURNAL = 0xFF
+
+COMPACT_FRAGMENTATION = 2
+
 ###############################################################################
 
 class MapSizeException(Exception): pass
+class NVMQuotaException(Exception): pass
+class NVMCorruptException(ValueError): pass
+
+###############################################################################
+
+def _slot_check(fields) -> int:
+    return crc32(fields) & 0xFFFF
+
+def _pack_slot(name_hash: int, start: int, stop: int, data_type: int, crc: int) -> bytes:
+    fields = struct.pack(_SLOT_FIELDS, name_hash, start, stop, data_type, crc)
+    return fields + struct.pack("<H", _slot_check(fields))
 
 ###############################################################################
 
 class _NVM:
-    
+
     def __init__(self):
         self._NVM_SIZE = len(board_NVM)  # Ensure `board_NVM` is passed
-        self._SIZE_START = 0
-        self._SIZE_STRING_SIZE = 5
-        self._SIZE_DATA_START = self._SIZE_START + self._SIZE_STRING_SIZE
-        self._SIZE_DATA_SIZE = 4
         self._DATA_START = self._NVM_SIZE // 10  # 10% of NVM size
-        self._MAP_START = 9  # Starting index for the map
+        self._MAP_START = struct.calcsize(_HEADER)  # Starting index for the slot index
         self._MAX_MAP_SIZE = self._DATA_START - self._MAP_START  # Max map size should be positive
         self._MAX_DATA_SIZE = self._NVM_SIZE - self._DATA_START  # Remaining space for data
+        self._SLOT_COUNT = self._MAX_MAP_SIZE // _SLOT_SIZE
 
         # Ensure that the calculated sizes are valid
         if self._MAX_MAP_SIZE < 0:
             raise ValueError("Map size calculation resulted in a negative value. Check your NVM layout.")
+        if self._NVM_SIZE > 0xFFFF:
+            raise ValueError("NVM too large for 16 bit slot addresses. Check your NVM layout.")
 
+        self.bytes_written = 0
+        self.damaged = []  # entries dropped at boot, see fsck()
         self._read_in_map()
 
+    def _write(self, offset: int, data) -> None:
+        """Every write to NVM goes through here so it can be counted."""
+        board_NVM[offset:offset + len(data)] = data
+        self.bytes_written += len(data)
+
+    def _read_header(self):
+        """Return the (magic, version, slot size, slot count) header tuple."""
+        return struct.unpack(_HEADER, board_NVM[0:self._MAP_START])
+
+    def _write_header(self):
+        self._write(0, struct.pack(_HEADER, _HEADER_MAGIC, _HEADER_VERSION, _SLOT_SIZE, self._SLOT_COUNT))
+
     def _get_map_size(self):
         # Get the first 5 bytes from the NVM (to check for the string 'size:')
         data = board_NVM[0:5]
-        
-        # Decode the first 5 bytes to string
-        s = data.decode("utf-8")
-        
+
         # Check if the string matches 'size:'
-        if s == 'size:':
+        if data == _LEGACY_MAGIC:
             # Extract the next 4 bytes (bytes 5, 6, 7, and 8) for the integer size
             data = board_NVM[5:9]  # slicing 5 to 9 includes byte 8
             size = struct.unpack("I", data)[0]  # Unpack as unsigned int (I)
@@ -54,359 +140,811 @@ class _NVM:
             return 0
 
     def _read_in_map(self):
-        # Get the map size
-        map_size = self._get_map_size()
+        self.map = {}
+        self._owners = {}  # record start -> name, so compaction can find a block's entry
+        self._free_slots = []
+        self._batch = None
+        self._batch_depth = 0
+
+        magic, version, slot_size, slot_count = self._read_header()
+
+        if magic == _LEGACY_MAGIC:
+            self._migrate_json_map()
+            return
 
-        if map_size == 0: #No map needs to create one:
-            self.map = {}
-            log("_read_in_map:> MAP_SIZE = 0: Creating blank map")
-            self._build_list()
+        if magic != _HEADER_MAGIC or version != _HEADER_VERSION or slot_size != _SLOT_SIZE or slot_count != self._SLOT_COUNT:
+            log("_read_in_map:> No slot index found: Creating blank index")
+            self.erase_all()
             return
 
+        # Read the whole index in one go and walk it with unpack_from.
+        index = board_NVM[self._MAP_START:self._MAP_START + self._SLOT_COUNT * _SLOT_SIZE]
+        entries = []
+        for slot in range(self._SLOT_COUNT):
+            offset = slot * _SLOT_SIZE
+            name_hash, start, stop, data_type, crc, check = struct.unpack_from(_SLOT, index, offset)
+            if start == 0:
+                self._free_slots.append(slot)
+                continue
+            fields = memoryview(index)[offset:offset + _SLOT_FIELDS_SIZE]
+            name = self._read_name(name_hash, start, stop) if check == _slot_check(fields) else None
+            if name is None:
+                log(f"_read_in_map:> Slot {slot} is corrupt: Dropping it")
+                self.damaged.append(f"slot {slot}")
+                self._write_slot(slot)
+                self._free_slots.append(slot)
+                continue
+            if data_type == _TYPE_JOURNAL:
+                # A committed batch that was not fully copied into the index.
+                self._replay_journal(slot, start, stop, crc)
+                return self._read_in_map()
+            entries.append((start, stop, data_type, slot, name))
+
+        # Drop any entry that overlaps the one before it.
+        position = self._DATA_START
+        for start, stop, data_type, slot, name in sorted(entries):
+            if start < position or name in self.map:
+                log(f"_read_in_map:> Entry '{name}' overlaps another: Dropping it")
+                self.damaged.append(name)
+                self._write_slot(slot)
+                self._free_slots.append(slot)
+                continue
+            self._set_entry(name, [start, stop, data_type, slot])
+            position = stop
+
+        self._build_list()
+
+    def _read_name(self, name_hash: int, start: int, stop: int):
+        """Read the name stored at the front of a record. Returns None if the
+        record does not belong to a slot with the given name hash."""
+        if start < self._DATA_START or stop > self._NVM_SIZE or stop <= start:
+            return None
+        name_len = board_NVM[start]
+        if start + 1 + name_len > stop:
+            return None
+        name_bytes = board_NVM[start + 1:start + 1 + name_len]
+        if crc32(name_bytes) != name_hash:
+            return None
+        try:
+            return name_bytes.decode("utf-8")
+        except Exception:
+            return None
+
+    def _replay_journal(self, slot: int, start: int, stop: int, crc: int):
+        record = board_NVM[start:stop]
+        if crc32(record) == crc:
+            log("_replay_journal:> Replaying unfinished batch")
+            journal = record[1 + record[0]:]
+            updates = []
+            for offset in range(0, len(journal) - _JOURNAL_ENTRY_SIZE + 1, _JOURNAL_ENTRY_SIZE):
+                target = struct.unpack_from(_JOURNAL_ENTRY, journal, offset)[0]
+                packed = journal[offset + _JOURNAL_SLOT_OFFSET:offset + _JOURNAL_ENTRY_SIZE]
+                updates.append((target, packed))
+            self._write_slots(updates)
+        else:
+            log("_replay_journal:> Journal is corrupt: Dropping it")
+            self.damaged.append(_JOURNAL_NAME)
+        self._write_slot(slot)
+
+    def _migrate_json_map(self):
+        """Convert the old json map into slots, keeping all of the saved data."""
+        map_size = self._get_map_size()
         if map_size > self._MAX_MAP_SIZE:
-            log("_read_in_map:> Recorded map size too large. Setting to Max")
+            log("_migrate_json_map:> Recorded map size too large. Setting to Max")
             map_size = self._MAX_MAP_SIZE
-        # Read the data from NVM based on the map size
-        data = board_NVM[self._MAP_START:self._MAP_START + map_size]
-        
-        # Decode the byte data to a UTF-8 string
-        decoded_data = data.decode("utf-8")
-        
+
+        entries = []
         try:
-            # Load the decoded string into a JSON object
-            self._map = json.loads(decoded_data)
-        except ValueError as e:
-            # Handle invalid JSON format
-            log(f"_read_in_map:> Error decoding JSON: {e}")
-            log(f"_read_in_map:> Map Corruption: RESETTING")
-            self.map = {}
+            old_map = json.loads(board_NVM[self._MAP_START:self._MAP_START + map_size].decode("utf-8"))
+            for name, (start, stop, data_type) in old_map.items():
+                entries.append((name, board_NVM[start:stop], data_type))
         except Exception as e:
-            # Handle any other errors that may occur
-            log(f"_read_in_map:> Unexpected error while reading map: {e}")
-            log(f"_read_in_map:> Map Corruption: RESETTING")
-            self.map = {}
+            log(f"_migrate_json_map:> Error decoding JSON: {e}")
+            log(f"_migrate_json_map:> Map Corruption: RESETTING")
+            entries = []
 
-        self._build_list()
+        self.erase_all()
+        for name, data, data_type in entries:
+            self.save_data(name, data, data_type)
+        log(f"_migrate_json_map:> Migrated {len(entries)} entries to the slot index")
 
     def _print_map(self, map):
         return json.dumps(map)
 
     def _build_list(self):
-        global _mbl
-        MAX = self._NVM_SIZE
-        MIN = self._DATA_START
-        # Check if the map is loaded
-        if not self.map:
-            mb = _MemoryBlock(self._DATA_START, self._DATA_START + self._MAX_DATA_SIZE, 0)
-            _mbl = _MemoryBlockList(mb)
-            log("_build_list:> No map to build from.")
-            return        
-
-        # Iterate over the map and create memory blocks for each item
-        for key, value in self.map.items():
-            new_block = _MemoryBlock(value[0],value[1], 1)
-            _mbl.insert(new_block)
-
-        for block in _mbl:
-            if block.block_type == 1:
-                start = block.start
-                stop = block.stop
-                # If this is the first in the list and it isn't a FREE block 
-                # Create a free block and inster it into the list.
-                if block.prev is None and start is not MIN:
-                    mb = _MemoryBlock(MIN, start, 0)
-                    _mbl.insert(mb)
-
-                # It's the last in the list and all the memory isn't accounted for
-                # Create a free block with the size difference between MAX and block.stop
-                if block.next is None and stop < MAX:
-                    mb = _MemoryBlock(stop, MAX, 0)
-                    _mbl.insert(mb)
-
-                # There is a node behind me. Check if its stop point is less the my start
-                # If it is then create a free block and insert it into the list.
-                if block.prev:
-                    prev_stop = block.prev.stop
-                    if prev_stop < start:
-                        mb = _MemoryBlock(prev_stop, start, 0)
-                        _mbl.insert(mb)
+        # Tile the data region with the used records and FREE blocks for the gaps.
+        used = sorted((value[0], value[1]) for value in self.map.values())
+        _mbl.rebuild(self._DATA_START, self._NVM_SIZE, used)
 
     def print_memory_block_details(self):
-        current = _mbl.head
-        if not current:
+        if not len(_mbl):
             print("Memory block list is empty.")
             return
-        
+
         print("Memory Block List:")
         node_index = 1
-        while current:
-            block_type = "FREE" if current.block_type == 0 else "USED"
+        for start, stop, block_type in _mbl:
             print(f"Node {node_index}:")
-            print(f"  Start: {current.start}")
-            print(f"  Stop: {current.stop}")
-            print(f"  Block Type: {block_type} (Type Code: {current.block_type})")
-            print(f"  Next Node: {current.next if current.next else 'None'}")
+            print(f"  Start: {start}")
+            print(f"  Stop: {stop}")
+            print(f"  Block Type: {'FREE' if block_type == 0 else 'USED'} (Type Code: {block_type})")
             print("-" * 30)  # separator between nodes
-            current = current.next
             node_index += 1
+        print(f"Free: {_mbl.free_bytes()} bytes, largest FREE block: {_mbl.largest_free()} bytes")
         print("End of Memory Block List.")
 
-    def _set_size(self, size: int) -> None:
-        """Set the map size and handle associated state updates."""
-        self._map_size = size
-        data = bytearray("size:", "utf-8")
-        board_NVM[self._SIZE_START:self._SIZE_START+self._SIZE_STRING_SIZE] = data
-        data = bytearray(struct.pack("I", size))
-        board_NVM[self._SIZE_DATA_START:self._SIZE_DATA_START + self._SIZE_DATA_SIZE] = data
+    def _write_slot(self, slot: int, name_hash: int = 0, start: int = 0, stop: int = 0, data_type: int = 0, crc: int = 0) -> None:
+        """Write a single slot of the index. Called with only a slot it empties it."""
+        offset = self._MAP_START + slot * _SLOT_SIZE
+        self._write(offset, _pack_slot(name_hash, start, stop, data_type, crc) if start else bytes(_SLOT_SIZE))
 
-        if size == 0:
-            log("_set_size:> Warning: The map is empty.")
+    def _write_slots(self, updates) -> None:
+        """Write many (slot, packed slot) pairs with a single write covering
+        the lowest to the highest slot."""
+        if not updates:
+            return
+        first = min(slot for slot, _ in updates)
+        last = max(slot for slot, _ in updates)
+        offset = self._MAP_START + first * _SLOT_SIZE
+        index = board_NVM[offset:offset + (last - first + 1) * _SLOT_SIZE]
+        for slot, packed in updates:
+            position = (slot - first) * _SLOT_SIZE
+            index[position:position + _SLOT_SIZE] = packed
+        self._write(offset, index)
+
+    def _new_slot(self) -> int:
+        if not self._free_slots:
+            raise MapSizeException(f"Map full, all {self._SLOT_COUNT} slots are used")
+        return self._free_slots.pop()
 
     def erase_all(self) -> None:
-        """Sets the index map size to 0 so a new map will be drawn next read."""
-        data = bytearray("size:", "utf-8")
-        board_NVM[self._SIZE_START:self._SIZE_START+self._SIZE_STRING_SIZE] = data
-        data = bytearray(struct.pack("I", 0))
-        board_NVM[self._SIZE_DATA_START:self._SIZE_DATA_START + self._SIZE_DATA_SIZE] = data
-
-    def save_data(self, name: str, base64_data: Base64Wrapper):
-        """Save data to the NVM and update the map and memory block list."""
+        """Write a blank header and index so all saved data is forgotten."""
+        self._write_header()
+        self._write(self._MAP_START, bytes(self._SLOT_COUNT * _SLOT_SIZE))
+        self.map = {}
+        self._owners = {}
+        self._free_slots = list(range(self._SLOT_COUNT - 1, -1, -1))
+        self._build_list()
+
+    def _pack_record(self, name_bytes: bytes, data) -> bytearray:
+        if len(name_bytes) > 0xFF:
+            raise ValueError(f"Name too long: '{name_bytes}'")
+        record = bytearray(1 + len(name_bytes) + len(data))
+        record[0] = len(name_bytes)
+        record[1:1 + len(name_bytes)] = name_bytes
+        record[1 + len(name_bytes):] = data
+        return record
+
+    def begin_batch(self) -> None:
+        """Stage saves and frees in RAM until the outermost end_batch()."""
+        if self._batch_depth == 0:
+            self._batch = {}
+        self._batch_depth += 1
+
+    def end_batch(self, commit: bool = True) -> None:
+        self._batch_depth -= 1
+        if self._batch_depth > 0:
+            return
+        staged = self._batch
+        self._batch = None
+        if commit and staged:
+            self._commit_batch(staged)
+
+    def _commit_batch(self, staged: dict) -> None:
+        """Write every staged entry, then switch all of their slots at once."""
+        saves = [(name, data, data_type) for name, (data, data_type) in staged.items() if data is not None]
+        frees = [name for name, (data, _) in staged.items() if data is None and name in self.map]
+
+        records = [self._pack_record(name.encode("utf-8"), data) for name, data, _ in saves]
+        journal_size = 1 + len(_JOURNAL_NAME) + (len(saves) + len(frees)) * _JOURNAL_ENTRY_SIZE
+
+        # Reserve the slots first so a full index fails before anything is written.
+        new_names = [name for name, _, _ in saves if name not in self.map]
+        if len(self._free_slots) < len(new_names) + 1:
+            raise MapSizeException(f"Map full, all {self._SLOT_COUNT} slots are used")
+        slots = {name: self._new_slot() for name in new_names}
+        journal_slot = self._new_slot()
+
+        # New records never overwrite the ones they replace, so until the
+        # journal slot is written the old entries are untouched.
+        spans = self._allocate_all([len(record) for record in records] + [journal_size])
+        if spans is None:
+            self.compact_memory()
+            spans = self._allocate_all([len(record) for record in records] + [journal_size])
+        if spans is None:
+            self._free_slots.extend(slots.values())
+            self._free_slots.append(journal_slot)
+            raise MemoryBlockListException("Not enough space in memory to store batch.")
+
+        updates = []
+        new_map = {}
+        for (name, data, data_type), record, (start, end) in zip(saves, records, spans):
+            self._write(start, record)
+            slot = slots[name] if name in slots else self.map[name][3]
+            packed = _pack_slot(crc32(name.encode("utf-8")), start, end, data_type, crc32(record))
+            updates.append((slot, packed))
+            new_map[name] = [start, end, data_type, slot]
+        for name in frees:
+            updates.append((self.map[name][3], bytes(_SLOT_SIZE)))
+
+        journal = bytearray()
+        for slot, packed in updates:
+            journal += struct.pack(_JOURNAL_ENTRY, slot)
+            journal += packed
+        journal_record = self._pack_record(_JOURNAL_NAME.encode("utf-8"), journal)
+        journal_start, journal_end = spans[-1]
+        self._write(journal_start, journal_record)
+
+        # Commit marker, then copy the journal into the index and drop it.
+        self._write_slot(journal_slot, crc32(_JOURNAL_NAME.encode("utf-8")), journal_start, journal_end, _TYPE_JOURNAL, crc32(journal_record))
+        self._write_slots(updates)
+        self._write_slot(journal_slot)
+
+        # Bring the RAM side in line with what is now on NVM.
+        self._free_slots.append(journal_slot)
+        _mbl.free(journal_start, journal_end)
+        for name in frees:
+            start, stop, _, slot = self._drop_entry(name)
+            _mbl.free(start, stop)
+            self._free_slots.append(slot)
+        for name, entry in new_map.items():
+            if name in self.map:
+                _mbl.free(self.map[name][0], self.map[name][1])
+            self._set_entry(name, entry)
+
+    def _set_entry(self, name: str, entry: list) -> None:
+        """Put an entry in the map and keep the reverse index in step."""
+        old = self.map.get(name)
+        if old is not None:
+            self._owners.pop(old[0], None)
+        self.map[name] = entry
+        self._owners[entry[0]] = name
+
+    def _drop_entry(self, name: str) -> list:
+        entry = self.map.pop(name)
+        self._owners.pop(entry[0], None)
+        return entry
+
+    def _allocate_all(self, sizes):
+        """Mark space used for every size, or for none of them. Returns the
+        list of (start, end) spans or None."""
+        spans = []
+        for size in sizes:
+            span = _mbl.allocate(size)
+            if span is None:
+                for start, end in spans:
+                    _mbl.free(start, end)
+                return None
+            spans.append(span)
+        return spans
+
+    def save_data(self, name: str, data, data_type: int):
+        """Save data to the NVM and update its slot and the memory block list."""
+        if self._batch is not None:
+            self._batch[name] = (bytes(data), data_type)
+            return
+
         map = self.map
+        name_bytes = name.encode("utf-8")
+        record = self._pack_record(name_bytes, data)
+        size = len(record)
+
         # If that save file is already in the list see if we can save it in the same place first
-        # If it is the same size, write directly over it.
-        # If it is smaller keep the same start and change the stop.
-        # We then need to create a new FREE block for the remaining space
+        # If it is the same size or smaller keep the same start and change the stop.
         # If it is larger find it a new space.
         # Remove the old space first incase you need to compact for the new one
         # Last write the new data to its new home.
         if name in map:
-            old_meta = [map[name][0], map[name][1]]
-            size = old_meta[1] - old_meta[0]
-            if size >= base64_data.size:
-                # Save and record new entry
-                board_NVM[map[name][0]:map[name][0]+base64_data.size] = base64_data.data
-                map[name][1] = map[name][0]+base64_data.size
-                map[name][2] = base64_data.data_type
-                # If it was larger then create the free block
-                if size > base64_data.size:
-                    _mbl.insert(_MemoryBlock(map[name][1],old_meta[1],0))
-
-                self.map = map
+            start, stop, _, slot = map[name]
+            if stop - start >= size:
+                self._write(start, record)
+                _mbl.shrink(start, stop, start + size)
+                self._set_entry(name, [start, start + size, data_type, slot])
+                self._write_slot(slot, crc32(name_bytes), start, start + size, data_type, crc32(record))
                 return
             # Else it needs a new spot and its old spot freed
-            else:
-                for block in _mbl:
-                    if block.start == old_meta[0] and block.stop == old_meta[1]:
-                        del map[name]
-                        _mbl.free(block)
-                        break
-
-        start_end = self._find_new_space(base64_data.size)  # Find space for data.
-        if start_end is None:
-            raise ValueError("Not enough save space in memory blocks.")
+            _mbl.free(start, stop)
+            self._drop_entry(name)
+        else:
+            slot = self._new_slot()
 
-        start, end = start_end
+        try:
+            start, end = self._find_new_space(size)  # Find space for data.
+        except MemoryBlockListException:
+            self._write_slot(slot)
+            self._free_slots.append(slot)
+            raise
 
         # Store data in NVM
-        board_NVM[slice(*start_end)] = base64_data.data
-
-        # Update memory block list to mark the block as used
-        current = _mbl.head
-        while current:
-            if current.start == start and current.stop >= end:
-                # We found the block and now we mark it as used
-                current.block_type = current._USED
-
-                # If the block is larger than the data, we might need to split it.
-                if current.stop > end:
-                    new_block = _MemoryBlock(end, current.stop, current._FREE)
-                    _mbl.insert(new_block)  # Insert the remaining free block after the used block
-                    current.stop = end  # Adjust the used block's stop to fit the saved data
-                break
-            current = current.next
-
-        # Update the memory map with the new data.
-        map[name] = list(start_end) + [base64_data.data_type]
-        self.map = map
-
-    def read_data(self, name:str):
+        self._write(start, record)
+
+        # Update the memory map and the slot with the new data.
+        self._set_entry(name, [start, end, data_type, slot])
+        self._write_slot(slot, crc32(name_bytes), start, end, data_type, crc32(record))
+
+    def free_bytes(self) -> int:
+        return _mbl.free_bytes()
+
+    def record_size(self, name: str, length: int) -> int:
+        """NVM bytes an entry with a `length` byte value takes up."""
+        return 1 + len(name.encode("utf-8")) + length
+
+    def entry_size(self, name: str) -> int:
+        start, stop, _, _ = self.map[name]
+        return stop - start
+
+    def locate(self, name: str):
+        """(buffer, value start, value stop, data type) for an entry, without
+        copying its value out of NVM."""
+        if self._batch is not None and name in self._batch:
+            data, data_type = self._batch[name]
+            if data is None:
+                raise ValueError(f"No entry found for '{name}' in map.")
+            return data, 0, len(data), data_type
         if name not in self.map:
             raise ValueError(f"No entry found for '{name}' in map.")
-        metadata = self.map[name]
-        if not isinstance(metadata, list):
-            raise ValueError("metadata not of type \"list\"")
-        return board_NVM[metadata[0]:metadata[1]], metadata[2]
+        start, stop, data_type, _ = self.map[name]
+        return board_NVM, start + 1 + board_NVM[start], stop, data_type
 
-    def _find_new_space(self, length: int):
-        """Find an available block of memory that can fit the data."""
-        def search():
-            current = _mbl.head
-            while current:
-                if current.block_type == current._FREE and current.size() >= length:
-                    return (current.start, current.start + length)
-                current = current.next
-            return None
+    def read_data(self, name:str):
+        source, start, stop, data_type = self.locate(name)
+        if source is not board_NVM:
+            return source[start:stop], data_type
+
+        # Check the whole record against its crc before handing the value back
+        record_start, _, _, slot = self.map[name]
+        record = board_NVM[record_start:stop]
+        if crc32(record) != self._slot_crc(slot):
+            self._drop_damaged(name)
+            raise NVMCorruptException(f"Entry '{name}' failed its crc check and was dropped.")
+        return record[start - record_start:], data_type
+
+    def check_data(self, name: str) -> None:
+        """Check an entry's record against its crc a chunk at a time, so a
+        large one is never in RAM at once. A damaged entry is dropped, the
+        same as in read_data()."""
+        if (self._batch is not None and name in self._batch) or name not in self.map:
+            return
+        start, stop, _, slot = self.map[name]
+        crc = 0
+        for offset in range(start, stop, NVM_CHUNK_SIZE):
+            crc = crc32(board_NVM[offset:min(offset + NVM_CHUNK_SIZE, stop)], crc)
+        if crc != self._slot_crc(slot):
+            self._drop_damaged(name)
+            raise NVMCorruptException(f"Entry '{name}' failed its crc check and was dropped.")
+
+    def _slot_crc(self, slot: int) -> int:
+        offset = self._MAP_START + slot * _SLOT_SIZE + _SLOT_CRC_OFFSET
+        return struct.unpack("<I", board_NVM[offset:offset + 4])[0]
+
+    def _drop_damaged(self, name: str) -> None:
+        log(f"_drop_damaged:> Entry '{name}' failed its crc check: Dropping it")
+        start, stop, _, slot = self._drop_entry(name)
+        _mbl.free(start, stop)
+        self._write_slot(slot)
+        self._free_slots.append(slot)
+
+    def fsck(self, full: bool = True, repair: bool = True) -> dict:
+        """Report the entries dropped at boot and, when `full`, check every
+        record against its crc. Damaged records are dropped if `repair`."""
+        damaged = list(self.damaged)
+        checked = 0
+        if full:
+            for name, (start, stop, _, slot) in list(self.map.items()):
+                checked += 1
+                if crc32(board_NVM[start:stop]) != self._slot_crc(slot):
+                    damaged.append(name)
+                    if repair:
+                        self._drop_damaged(name)
+        return {"checked": checked, "damaged": damaged}
 
+    def _find_new_space(self, length: int):
+        """Find the best fitting free block for the data and mark it used."""
         # First attempt to find space
-        result = search()
+        result = _mbl.allocate(length)
         if result:
             return result
 
         # If no space found, compact memory and try again
         self.compact_memory()
-        result = search()
+        result = _mbl.allocate(length)
         if result:
             return result
 
         # If still no space, raise
         raise MemoryBlockListException("Not enough space in memory to store data.")
-        
+
     def free_data(self, name: str):
         """Free the data associated with the given name and update the memory block list."""
-        map_copy = self.map
+        if self._batch is not None:
+            self._batch[name] = (None, None)
+            return
 
-        if name not in map_copy:
+        if name not in self.map:
             log(f"free_data:> Data with name '{name}' not found in map.")
             return
 
-        start, end, data_type = map_copy[name]
+        start, end, data_type, slot = self._drop_entry(name)
         # Mark the corresponding memory block as free
-        current = _mbl.head
-        while current:
-            if current.start == start and current.stop == end:
-                current.block_type = current._FREE
-                _mbl._clean()
-                break
-            current = current.next
-
-        # Remove from map and reassign to trigger the setter
-        del map_copy[name]
-        self.map = map_copy
-
-        log(f"free_data:> Data with name '{name}' has been freed and removed from map.")
-
-    def compact_memory(self):
-        """Compacts memory by moving used blocks down and merging free space."""
-
-        map_copy = self.map
-        current = _mbl.head
-
-        new_position = self._DATA_START # Where the next used block should go
-
-        while current:
-            block_size = current.stop - current.start
-
-            if current.block_type == current._USED:
-                if current.start != new_position:
-                    # Physically move the data
-                    board_NVM[new_position:new_position + block_size] = board_NVM[current.start:current.stop]
-                    
-                    # Update map to reflect new position
-                    for name, (start, end, data_type) in map_copy.items():
-                        if start == current.start and end == current.stop:
-                            map_copy[name] = (new_position, new_position + block_size, data_type)
-                            break
+        _mbl.free(start, end)
 
-                    # Update the memory block itself
-                    current.start = new_position
-                    current.stop = new_position + block_size
+        # Empty the slot so the entry is gone after the next boot
+        self._write_slot(slot)
+        self._free_slots.append(slot)
 
-                # Advance new_position
-                new_position += block_size
-
-            current = current.next
-
-        # After moving all used blocks, fix the free block
-        if new_position < self._MAP_START:
-            # There should be exactly one free block now
-            free_block = _mbl.head
-            while free_block.next:
-                free_block = free_block.next
-            
-            free_block.start = new_position
-            free_block.stop = self._MAP_START
-            free_block.block_type = free_block._FREE
-            free_block.next = None
-
-        self.map = map_copy  # Trigger setter to update map storage
-
-
-    @property
-    def map(self):
-        """Getter for the map."""
-        return self._map
-
-    @map.setter
-    def map(self, new_map):
-        """Setter for the map that also updates the size."""
-        if not isinstance(new_map, dict):
-            raise ValueError("The map must be a dictionary.")
-
-        json_data = json.dumps(new_map)
-        data = bytearray(json_data, "utf-8")
-        map_size = len(data)
-
-        if map_size > self._MAX_MAP_SIZE:
-            raise MapSizeException("Map size too large" +f"size: {map_size}, allowed: {self._MAX_MAP_SIZE}")
+        log(f"free_data:> Data with name '{name}' has been freed and removed from map.")
 
-        self._map = new_map
+    def needs_compaction(self) -> bool:
+        return _mbl.largest_free() * COMPACT_FRAGMENTATION < _mbl.free_bytes() and _mbl.first_hole() is not None
+
+    def compact_memory(self, budget_ms: int = None) -> bool:
+        """Compacts memory by sliding used records down into the FREE block in
+        front of them. With a budget it stops once that many milliseconds have
+        passed. Returns True once the FREE space is all in one block."""
+        deadline = None if budget_ms is None else monotonic_ns() + budget_ms * 1_000_000
+
+        while True:
+            hole = _mbl.first_hole()
+            if hole is None:
+                return True
+
+            _, start, stop = hole
+            name = self._owners[start]
+            _, _, data_type, slot = self.map[name]
+
+            # Physically move the data
+            record = board_NVM[start:stop]
+            new_start, new_stop = _mbl.slide_down(start)
+            self._write(new_start, record)
+
+            # Update the map and the slot to reflect the new position
+            self._set_entry(name, [new_start, new_stop, data_type, slot])
+            self._write_slot(slot, crc32(name.encode("utf-8")), new_start, new_stop, data_type, crc32(record))
+
+            # At least one record is moved per call, so a tiny budget still makes progress
+            if deadline is not None and monotonic_ns() >= deadline:
+                return _mbl.first_hole() is None
+
+def _open_store(mode: str = None):
+    """Open the store the NVM is formatted as, or a blank one of `mode`."""
+    if mode is None:
+        mode = NVM_MODE_LOG if board_NVM[0:len(LOG_MAGIC)] == LOG_MAGIC else NVM_MODE_SLOT
+        return _LogNVM() if mode == NVM_MODE_LOG else _NVM()
+    if mode not in (NVM_MODE_SLOT, NVM_MODE_LOG):
+        raise ValueError(f"Unknown NVM mode: {mode}")
+    store = _LogNVM() if mode == NVM_MODE_LOG else _NVM()
+    store.erase_all()
+    return store
+
+_nvm = _open_store()
+_last_write = 0
 
-        board_NVM[self._MAP_START:self._MAP_START + map_size] = data
-        # Update the map size based on the new map
-        self._set_size(map_size) 
+###############################################################################
+# Decoded values are kept in a small cache so boot config and high scores are
+# not read and decoded again on every nvm_open(). Anything that writes an
+# entry drops it from the cache. Values read while a batch is open are not
+# cached since the batch may still be thrown away. Lists and dicts are kept as
+# their encoded bytes and decoded again on a hit, so a caller changing what
+# it got back does not change what the next caller sees. The cache is an
+# OrderedDict, since plain dicts on the badge don't keep insertion order, and
+# a hit moves the entry to the end so the least recently read is evicted.
+
+NVM_CACHE_SIZE = 8
+
+_cache = OrderedDict()
+_cache_hits = 0
+_cache_misses = 0
+
+def _cache_put(name: str, value) -> None:
+    if name not in _cache and len(_cache) >= NVM_CACHE_SIZE:
+        # Evict the least recently read entry
+        del _cache[next(iter(_cache))]
+    _cache[name] = value
+
+def _cache_drop(name: str = None) -> None:
+    """Forget one cached value, or all of them when no name is given."""
+    if name is None:
+        _cache.clear()
+    else:
+        _cache.pop(name, None)
 
-_nvm = _NVM()
+###############################################################################
+# Apps keep their entries under app/<appdir>/<key>. nvm_keys() looks names up
+# in a sorted list of the map's names, which is rebuilt the next time it is
+# needed after a name is added or removed. Every app namespace is held to
+# NVM_APP_QUOTA bytes of NVM unless nvm_set_quota() says otherwise.
+
+NVM_APP_PREFIX = "app/"
+NVM_APP_QUOTA = 1024
+
+_names = None
+_quotas = {}
+
+def _names_changed() -> None:
+    global _names
+    _names = None
+
+def _namespace(name: str):
+    """The app/<appdir>/ namespace `name` is in, or None."""
+    if not name.startswith(NVM_APP_PREFIX):
+        return None
+    end = name.find("/", len(NVM_APP_PREFIX))
+    return None if end == -1 else name[:end + 1]
+
+def _check_quota(name: str, length: int) -> None:
+    namespace = _namespace(name)
+    if namespace is None:
+        return
+    quota = _quotas.get(namespace, NVM_APP_QUOTA)
+    if quota is None:
+        return
+    used = sum(_nvm.entry_size(key) for key in nvm_keys(namespace) if key != name)
+    needed = _nvm.record_size(name, length)
+    if used + needed > quota:
+        raise NVMQuotaException(f"'{name}' needs {needed} bytes, {namespace} has {quota - used} of {quota} left")
+
+def _counts_writes(func):
+    """Record how many bytes `func` wrote to NVM for nvm_stats()."""
+    def wrapper(*args, **kwargs):
+        global _last_write
+        before = _nvm.bytes_written
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _last_write = _nvm.bytes_written - before
+    return wrapper
 
 ###############################################################################
 
 # Save data with memory block list integration
+@_counts_writes
 def nvm_save(name: str, data):
     """Save data to NVM, interacting with the memory block list."""
-    encoded_data = Base64Wrapper(data)
-    _nvm.save_data(name, encoded_data)
+    data_type, encoded_data = encode(data)
+    _check_quota(name, len(encoded_data))
+    _cache_drop(name)
+    if name not in _nvm.map:
+        _names_changed()
+    _nvm.save_data(name, encoded_data, data_type)
 
 
 # Open and return data from NVM
 def nvm_open(name: str):
+    """Open data from NVM, using the memory block list."""
+    global _cache_hits, _cache_misses
+    if name in _cache:
+        _cache_hits += 1
+        # Popped and put back, MicroPython's OrderedDict has no move_to_end()
+        data_type, value = _cache[name] = _cache.pop(name)
+        return decode(data_type, value) if is_container_type(data_type) else value
+    _cache_misses += 1
+
     try:
-        """Open data from NVM, using the memory block list."""
-        b64_data, data_type = _nvm.read_data(name)
-    except ValueError:
+        data, data_type = _nvm.read_data(name)
+    except NVMCorruptException:
+        # The entry was dropped, so the names and usage held for it are stale
+        _cache_drop(name)
+        _names_changed()
         raise
 
-    decoded_data = Base64Wrapper(data=b64_data, data_type=data_type)
-    return decoded_data.get()
+    if is_binary_type(data_type):
+        value = decode(data_type, data)
+    else:
+        # Entries saved before the binary codec are still base64.
+        value = Base64Wrapper(data=data, data_type=data_type).get()
+
+    if _nvm._batch is None:
+        _cache_put(name, (data_type, bytes(data) if is_container_type(data_type) else value))
+    return value
 
 # Delete saved data
+@_counts_writes
 def nvm_free(name: str):
     """Deletes the map entry and allocates as free space"""
+    _cache_drop(name)
+    _names_changed()
     _nvm.free_data(name)
 
-def nvm_compact():
-    """Trigger memory compaction to consolidate free space in NVM."""
-    _nvm.compact_memory()
+@_counts_writes
+def nvm_compact(budget_ms: int = None):
+    """Trigger memory compaction to consolidate free space in NVM. With a
+    budget_ms only that much time is spent, call it again to carry on.
+    Returns True when there is nothing left to compact."""
+    _cache_drop()
+    return _nvm.compact_memory(budget_ms)
+
+async def nvm_compact_task(budget_ms: int = 20, interval: float = 1.0):
+    """Compact NVM a few records at a time while the badge is idle, once the
+    free space is fragmented enough to need it. Add it to the tasks handed
+    to asyncio.gather()."""
+    import asyncio
+
+    while True:
+        if _nvm.needs_compaction():
+            nvm_compact(budget_ms)
+        await asyncio.sleep(interval)
 
 def nvm_info():
     """Print a summary of all saved entries in NVM, showing their ranges and data types."""
     print("NVM Map:")
-    for name, (start, stop, dtype) in _nvm.map.items():
+    for name, (start, stop, dtype, _) in _nvm.map.items():
         log(f"- {name}: {start}-{stop} ({dtype})")
-
-def nvm_format():
-    """Erase the entire NVM, clearing all saved data and resetting the map."""
-    _nvm.erase_all()
+    stats = nvm_stats()
+    log(f"- {stats['mode']}: {stats['free']} bytes free, {stats['bytes_written']} bytes written since boot")
+
+def nvm_stats():
+    """Return the store mode, free space and how many bytes have been written.
+    `last_write` is the byte count of the most recent save, free, compact or batch.
+    `cache_hits` and `cache_misses` count nvm_open() calls served from the cache."""
+    return {
+        "mode": NVM_MODE_LOG if isinstance(_nvm, _LogNVM) else NVM_MODE_SLOT,
+        "entries": len(_nvm.map),
+        "free": _nvm.free_bytes(),
+        "bytes_written": _nvm.bytes_written,
+        "last_write": _last_write,
+        "cache_hits": _cache_hits,
+        "cache_misses": _cache_misses,
+    }
+
+def nvm_format(mode: str = None):
+    """Erase the entire NVM, clearing all saved data and resetting the map.
+    Pass NVM_MODE_SLOT or NVM_MODE_LOG to switch the store type."""
+    global _nvm
+    _cache_drop()
+    _names_changed()
+    if mode is None:
+        _nvm.erase_all()
+    else:
+        _nvm = _open_store(mode)
+
+@_counts_writes
+def nvm_fsck(full: bool = True, repair: bool = True):
+    """Check NVM for damage and return {"checked": n, "damaged": [...]}.
+    The index is already checked at boot, full=False only reports what was
+    dropped then. A full check also verifies every entry's crc."""
+    _cache_drop()
+    _names_changed()
+    return _nvm.fsck(full, repair)
 
 def nvm_wipe():
-    """Delete each individual item in the NVM map one by one."""
-    for name in list(_nvm.map.keys()):
-        _nvm.free_data(name)
+    """Delete every item in the NVM map."""
+    nvm_free_prefix("")
+
+def nvm_keys(prefix: str = ""):
+    """Return the sorted names that start with `prefix`."""
+    global _names
+    if _names is None:
+        _names = sorted(_nvm.map)
+    index = _bisect(_names, prefix)
+    keys = []
+    while index < len(_names) and _names[index].startswith(prefix):
+        keys.append(_names[index])
+        index += 1
+    return keys
+
+def nvm_free_prefix(prefix: str) -> int:
+    """Free every name that starts with `prefix` in a single batch and return
+    how many were freed."""
+    keys = nvm_keys(prefix)
+    if not keys:
+        return 0
+    try:
+        with nvm_batch():
+            for name in keys:
+                nvm_free(name)
+    except (MemoryBlockListException, MapSizeException):
+        # Too many to fit in one batch, or no slot left for its journal when
+        # the index is full, so free them one at a time
+        for name in keys:
+            nvm_free(name)
+    return len(keys)
+
+def nvm_app_prefix(appdir: str) -> str:
+    """The namespace for an app, e.g. "/apps/totris" -> "app/totris/"."""
+    return f"{NVM_APP_PREFIX}{appdir.rstrip('/').split('/')[-1]}/"
+
+def nvm_app_key(appdir: str, key: str) -> str:
+    return nvm_app_prefix(appdir) + key
+
+def nvm_set_quota(namespace: str, max_bytes: int = NVM_APP_QUOTA):
+    """Limit the NVM bytes the names in an app namespace may take up.
+    None removes the limit."""
+    _quotas[namespace] = max_bytes
+
+def nvm_usage(prefix: str = "") -> int:
+    """NVM bytes taken up by the names that start with `prefix`."""
+    return sum(_nvm.entry_size(name) for name in nvm_keys(prefix))
+
+###############################################################################
+# bytes and str entries can be read straight into a caller's buffer a chunk at
+# a time, so a large blob never has to be in RAM more than once.
+
+NVM_CHUNK_SIZE = 64
+
+def _payload(name: str):
+    """(buffer, payload start, payload stop) of a bytes or str entry."""
+    source, start, stop, data_type = _nvm.locate(name)
+    offset, length = payload_span(data_type, source[start:start + 2])
+    start += offset
+    return source, start, min(start + length, stop)
+
+def nvm_size(name: str) -> int:
+    """Length of a bytes or str entry, so a buffer can be made to fit it."""
+    _, start, stop = _payload(name)
+    return stop - start
+
+def _check_data(name: str) -> None:
+    try:
+        _nvm.check_data(name)
+    except NVMCorruptException:
+        _cache_drop(name)
+        _names_changed()
+        raise
+
+def nvm_open_into(name: str, buf, offset: int = 0) -> int:
+    """Copy a bytes or str entry, starting `offset` bytes in, into `buf`.
+    Returns how many bytes were copied, 0 once `offset` is past the end.
+    Like nvm_open(), a damaged entry raises NVMCorruptException."""
+    _check_data(name)
+    return _copy_into(name, buf, offset)
+
+def _copy_into(name: str, buf, offset: int) -> int:
+    source, start, stop = _payload(name)
+    start = min(start + offset, stop)
+    view = memoryview(buf)
+    count = min(len(view), stop - start)
+
+    copied = 0
+    while copied < count:
+        chunk = min(NVM_CHUNK_SIZE, count - copied)
+        view[copied:copied + chunk] = source[start + copied:start + copied + chunk]
+        copied += chunk
+    return count
+
+def nvm_reader(name: str, chunk_size: int = NVM_CHUNK_SIZE):
+    """Yield a bytes or str entry in chunks. Every chunk is a memoryview of
+    the same buffer, so copy it if it has to outlive the next one. The entry
+    is looked up again for each chunk, so it is safe to compact in between.
+    It is checked against its crc once, before the first chunk."""
+    _check_data(name)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    offset = 0
+    while True:
+        count = _copy_into(name, buf, offset)
+        if count == 0:
+            return
+        yield view[:count]
+        offset += count
+
+class nvm_batch:
+    """Group several saves and frees into one commit.
+
+        with nvm_batch():
+            nvm_save("a", 1)
+            nvm_free("b")
+
+    Nothing reaches the index until the block exits. If it raises, every
+    staged change is dropped."""
+
+    def __enter__(self):
+        _nvm.begin_batch()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _cache_drop()
+        _names_changed()
+        self._end(exc_type is None)
+        return False
+
+    @_counts_writes
+    def _end(self, commit: bool):
+        _nvm.end_batch(commit=commit)
 
 def print_list():
-    current = _mbl.head
-    while current:
-        print(f"[{current.start}-{current.stop}] ({'FREE' if current.block_type == 0 else 'USED'} ({current.block_type}))", end=" -> ")
-        current = current.next
+    for start, stop, block_type in _mbl:
+        print(f"[{start}-{stop}] ({'FREE' if block_type == 0 else 'USED'} ({block_type}))", end=" -> ")
     print("None")
 
 def print_memory_block_details():
-    _nvm.print_memory_block_details()
\ No newline at end of file
+    _nvm.print_memory_block_details()
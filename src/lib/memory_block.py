@@ -1,4 +1,4 @@
-from badge.log import log
+from array import array
 
 ###############################################################################
 
@@ -6,170 +6,221 @@ class MemoryBlockException(Exception): pass
 class MemoryBlockListException(Exception): pass
 
 ###############################################################################
-
-class _MemoryBlock:
-    def __init__(self, start:int, stop:int, block_type:int):
-        self._FREE = 0
-        self._USED = 1
-
-        self.start = start
-        self.stop = stop
-        self.block_type = block_type
-
-        self.prev = None  # Previous block
-        self.next = None  # Next block
-
-
-    @property
-    def start(self) -> int:
-        return self._start
-
-    @start.setter
-    def start(self, value) -> None:
-        if value > 0:
-            self._start = value
+# The NVM data region is tiled by blocks that are either FREE or USED. The
+# table keeps them in three parallel arrays sorted by start address, so a
+# block is found with a binary search instead of walking a list.
+#
+# FREE blocks are also kept in segregated free lists, one per power of two
+# size class. Each list is a sorted array of (size << 16 | start) keys, so the
+# first key at or above (length << 16) in the smallest non empty class that
+# can hold `length` is the best fit.
+
+_FREE = 0
+_USED = 1
+
+_ADDRESS_BITS = 16
+_ADDRESS_MASK = (1 << _ADDRESS_BITS) - 1
+_SIZE_CLASSES = _ADDRESS_BITS + 1
+
+def _bisect(values, value: int) -> int:
+    """Index of the first item in the sorted `values` that is >= value."""
+    lo = 0
+    hi = len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] < value:
+            lo = mid + 1
         else:
-            raise MemoryBlockException("start value must be a positive int.")
+            hi = mid
+    return lo
 
-    @property
-    def stop(self) -> int:
-        return self._stop
+def _insert(values, index: int, value: int) -> None:
+    values[index:index] = array("I", (value,))
 
-    @stop.setter
-    def stop(self, value):
-        if value > self._start:
-            self._stop = value
-        else:
-            raise MemoryBlockException("stop value must be greater then start.")
-
-    def size(self) -> int:
-        return self._stop - self._start
-
-    def print(self):
-        log(f'<SELF[{id(self)}] : start[{self.start}] : stop[{self.stop}] : data_type[{self.block_type}], NEXT[{id(self.next)}] : PREV[{id(self.prev)}]>')
+def _remove(values, index: int) -> None:
+    values[index:index + 1] = array("I")
 
-    @property
-    def block_type(self) -> int:
-        return self._block_type
-
-    @block_type.setter
-    def block_type(self, value) -> None:
-        if (value == self._FREE) or (value == self._USED):
-            self._block_type = value
-        else:
-            raise MemoryBlockException("block_type must be either a 0 or 1")
-
-    def __lt__(self, other):
-        if not isinstance(other, _MemoryBlock):
-            return NotImplemented
-        return self.stop <= other.start
-
-    def __eq__(self, other):
-        if not isinstance(other, _MemoryBlock):
-            return NotImplemented
-        return self.start == other.start and self.stop == other.stop and self.block_type == other.block_type
-
-    def __gt__(self, other):
-        if not isinstance(other, _MemoryBlock):
-            return NotImplemented
-        return self.start <= other.stop
+def _size_class(size: int) -> int:
+    return size.bit_length() - 1
 
 ###############################################################################
 
-class _MemoryBlockList:
-    def __init__(self, new_block: _MemoryBlock = None):
-        self.head = None
-        self.tail = None
-        if new_block:
-            self.insert(new_block)
-
-    def insert(self, new_block: _MemoryBlock):
-        if self.head is None:
-            self.head = self.tail = new_block
+class _BlockTable:
+    def __init__(self, lo: int = 0, hi: int = 0, used=()):
+        self.rebuild(lo, hi, used)
+
+    def rebuild(self, lo: int, hi: int, used=()) -> None:
+        """Tile [lo, hi) with the sorted (start, stop) `used` spans and FREE
+        blocks for the gaps between them."""
+        if hi > _ADDRESS_MASK + 1:
+            raise MemoryBlockException("Address range too large for the block table.")
+        self.lo = lo
+        self.hi = hi
+        self.starts = array("I")
+        self.stops = array("I")
+        self.types = bytearray()
+        self._free = [array("I") for _ in range(_SIZE_CLASSES)]
+
+        position = lo
+        for start, stop in used:
+            if start < position or stop <= start or stop > hi:
+                raise MemoryBlockListException(f"Bad used span {start}-{stop}.")
+            if position < start:
+                self._append(position, start, _FREE)
+            self._append(start, stop, _USED)
+            position = stop
+        if position < hi:
+            self._append(position, hi, _FREE)
+
+    def _append(self, start: int, stop: int, block_type: int) -> None:
+        self.starts.append(start)
+        self.stops.append(stop)
+        self.types.append(block_type)
+        if block_type == _FREE:
+            self._add_free(start, stop)
+
+    def _add_free(self, start: int, stop: int) -> None:
+        size = stop - start
+        free = self._free[_size_class(size)]
+        key = (size << _ADDRESS_BITS) | start
+        _insert(free, _bisect(free, key), key)
+
+    def _drop_free(self, start: int, stop: int) -> None:
+        size = stop - start
+        free = self._free[_size_class(size)]
+        key = (size << _ADDRESS_BITS) | start
+        index = _bisect(free, key)
+        if index == len(free) or free[index] != key:
+            raise MemoryBlockListException(f"Free block {start}-{stop} is not in its free list.")
+        _remove(free, index)
+
+    def _index(self, start: int) -> int:
+        index = _bisect(self.starts, start)
+        if index == len(self.starts) or self.starts[index] != start:
+            raise MemoryBlockListException(f"No block starts at {start}.")
+        return index
+
+    def _insert_block(self, index: int, start: int, stop: int, block_type: int) -> None:
+        _insert(self.starts, index, start)
+        _insert(self.stops, index, stop)
+        self.types[index:index] = bytes((block_type,))
+        if block_type == _FREE:
+            self._add_free(start, stop)
+
+    def _remove_block(self, index: int) -> None:
+        if self.types[index] == _FREE:
+            self._drop_free(self.starts[index], self.stops[index])
+        _remove(self.starts, index)
+        _remove(self.stops, index)
+        self.types[index:index + 1] = b""
+
+    def find(self, length: int):
+        """Best fit FREE block for `length` bytes as (start, stop), or None."""
+        if length <= 0:
+            raise MemoryBlockException("length must be a positive int.")
+        key = length << _ADDRESS_BITS
+        for size_class in range(_size_class(length), _SIZE_CLASSES):
+            free = self._free[size_class]
+            index = _bisect(free, key)
+            if index < len(free):
+                best = free[index]
+                start = best & _ADDRESS_MASK
+                return start, start + (best >> _ADDRESS_BITS)
+        return None
+
+    def allocate(self, length: int):
+        """Mark the best fit for `length` bytes USED and return (start, end),
+        or None if no FREE block is large enough."""
+        block = self.find(length)
+        if block is None:
+            return None
+        start, stop = block
+        index = self._index(start)
+        self._drop_free(start, stop)
+        self.types[index] = _USED
+        end = start + length
+        if end < stop:
+            self.stops[index] = end
+            self._insert_block(index + 1, end, stop, _FREE)
+        return start, end
+
+    def free(self, start: int, stop: int) -> None:
+        """Mark a USED block FREE and merge it with FREE neighbours."""
+        index = self._index(start)
+        if self.stops[index] != stop or self.types[index] != _USED:
+            raise MemoryBlockListException(f"No USED block {start}-{stop}.")
+
+        if index + 1 < len(self.starts) and self.types[index + 1] == _FREE:
+            stop = self.stops[index + 1]
+            self._remove_block(index + 1)
+        if index > 0 and self.types[index - 1] == _FREE:
+            index -= 1
+            start = self.starts[index]
+            self._remove_block(index + 1)
+            self._drop_free(start, self.stops[index])
+        self.starts[index] = start
+        self.stops[index] = stop
+        self.types[index] = _FREE
+        self._add_free(start, stop)
+
+    def shrink(self, start: int, stop: int, new_stop: int) -> None:
+        """Give the tail of a USED block back as FREE space."""
+        if new_stop == stop:
             return
-
-        current = self.head
-        while current is not None and new_block.start > current.start:
-            current = current.next
-
-        if current is not None and current == new_block:
-            return  # Duplicate MemoryBlock, ignore.
-        if current is not None and current.start == new_block.start:
-            raise MemoryBlockListException("Block with duplicate start address but different end or type.")
-
-        if current is None:
-            self.tail.next = new_block
-            new_block.prev = self.tail
-            self.tail = new_block
-        elif current is self.head:
-            new_block.next = self.head
-            self.head.prev = new_block
-            self.head = new_block
-        else:
-            prev_block = current.prev
-            prev_block.next = new_block
-            new_block.prev = prev_block
-            new_block.next = current
-            current.prev = new_block
-
-    def remove(self, block: _MemoryBlock):
-        """Remove a block from the list."""
-        # Sanity check: is block in the list?
-        current = self.head
-
-        while current:
-            if current == block:
-                break
-            current = current.next
-        else:
-            # Only happens if we never broke from the loop
-            raise MemoryBlockListException("Cannot remove a block that is not in the list.")
-        # Now it's safe to remove
-        if block.prev:
-            block.prev.next = block.next
-        else:
-            # Block was head
-            self.head = block.next
-        if block.next:
-            block.next.prev = block.prev
-        else:
-            # Block was tail
-            self.tail = block.prev
-        # Clean up pointers
-        block.prev = None
-        block.next = None
-        return block
-
-    def pop(self):
-        if self.tail is not None:
-            self.remove(self.tail)
-        else:
-            raise MemoryBlockListException("Cannot pop from an empty list.")
-
-    def free(self, block:_MemoryBlock):
-        if block.block_type != block._USED:
-            raise MemoryBlockListException("block already free")
-        block.block_type = block._FREE
-        self._clean()
-
-    def _clean(self):
-        current = self.head
-        
-        while current is not None:
-            if current.next:
-                if current.block_type == 0 and current.next.block_type == 0:
-                    to_remove = current.next
-                    current.stop = to_remove.stop
-                    self.remove(to_remove)
-                else:
-                    current = current.next
-            else:
-                current = current.next
+        index = self._index(start)
+        if self.stops[index] != stop or self.types[index] != _USED or not start < new_stop < stop:
+            raise MemoryBlockListException(f"Cannot shrink {start}-{stop} to {new_stop}.")
+        self.stops[index] = new_stop
+        if index + 1 < len(self.starts) and self.types[index + 1] == _FREE:
+            stop = self.stops[index + 1]
+            self._remove_block(index + 1)
+        self._insert_block(index + 1, new_stop, stop, _FREE)
+
+    def first_hole(self):
+        """(free start, used start, used stop) for the first FREE block that
+        has a USED block after it, or None if the USED blocks are packed."""
+        for index in range(len(self.types) - 1):
+            if self.types[index] == _FREE:
+                return self.starts[index], self.starts[index + 1], self.stops[index + 1]
+        return None
+
+    def slide_down(self, start: int):
+        """Swap the USED block at `start` with the FREE block in front of it
+        and return the USED block's new (start, stop)."""
+        index = self._index(start)
+        if index == 0 or self.types[index - 1] != _FREE or self.types[index] != _USED:
+            raise MemoryBlockListException(f"No FREE block in front of {start}.")
+        free_start = self.starts[index - 1]
+        new_stop = free_start + self.stops[index] - start
+        stop = self.stops[index]
+
+        self._drop_free(free_start, start)
+        self.types[index - 1] = _USED
+        self.stops[index - 1] = new_stop
+        if index + 1 < len(self.starts) and self.types[index + 1] == _FREE:
+            stop = self.stops[index + 1]
+            self._remove_block(index + 1)
+        self.starts[index] = new_stop
+        self.stops[index] = stop
+        self.types[index] = _FREE
+        self._add_free(new_stop, stop)
+        return free_start, new_stop
+
+    def free_bytes(self) -> int:
+        return sum(self.stops[i] - self.starts[i] for i in range(len(self.starts)) if self.types[i] == _FREE)
+
+    def largest_free(self) -> int:
+        for free in reversed(self._free):
+            if free:
+                return free[-1] >> _ADDRESS_BITS
+        return 0
+
+    def __len__(self):
+        return len(self.starts)
 
     def __iter__(self):
-        current = self.head
-        while current:
-            yield current
-            current = current.next
+        """Yield (start, stop, block_type) for every block in address order."""
+        for i in range(len(self.starts)):
+            yield self.starts[i], self.stops[i], self.types[i]
 
-_mbl = _MemoryBlockList()
+_mbl = _BlockTable()
@@ -0,0 +1,158 @@
+import struct
+
+###############################################################################
+# Binary codec for values saved by badge_nvm.
+#
+# Every value is written as raw bytes with a type tag that badge_nvm keeps in
+# the entry's slot. bytes and str are prefixed with their length, the rest
+# are fixed size. Types 0-3 belong to Base64Wrapper and are left to it.
+#
+#   TYPE_BYTES  <H length> <bytes>
+#   TYPE_STR    <H length> <utf-8 bytes>
+#   TYPE_BOOL   <B 0|1>
+#   TYPE_INT    <q>
+#   TYPE_FLOAT  <d>
+#   TYPE_NONE   nothing
+#   TYPE_LIST   <H count> items
+#   TYPE_DICT   <H count> key item, value item, ...
+#
+# Items inside a list or dict are their <B type> tag followed by the same
+# encoding as above, so a dict saved from json.loads() round trips without
+# going through a JSON string. Tuples are saved as lists and dict keys must
+# be str or int.
+
+TYPE_BYTES = 0x10
+TYPE_STR = 0x11
+TYPE_BOOL = 0x12
+TYPE_INT = 0x13
+TYPE_FLOAT = 0x14
+TYPE_NONE = 0x15
+TYPE_LIST = 0x16
+TYPE_DICT = 0x17
+
+_LENGTH = "<H"
+_LENGTH_SIZE = struct.calcsize(_LENGTH)
+
+###############################################################################
+
+class NVMCodecException(ValueError): pass
+
+###############################################################################
+
+def is_binary_type(data_type: int) -> bool:
+    """True if data_type was written by this codec rather than Base64Wrapper."""
+    return data_type >= TYPE_BYTES
+
+def is_container_type(data_type: int) -> bool:
+    """True for values that decode to a new mutable list or dict."""
+    return data_type == TYPE_LIST or data_type == TYPE_DICT
+
+def _with_length(data) -> bytearray:
+    if len(data) > 0xFFFF:
+        raise NVMCodecException(f"Value too long: {len(data)} bytes")
+    out = bytearray(_LENGTH_SIZE + len(data))
+    struct.pack_into(_LENGTH, out, 0, len(data))
+    out[_LENGTH_SIZE:] = data
+    return out
+
+def _count(count: int) -> bytearray:
+    if count > 0xFFFF:
+        raise NVMCodecException(f"Too many items: {count}")
+    return bytearray(struct.pack(_LENGTH, count))
+
+def _encode_item(out: bytearray, value) -> None:
+    data_type, data = encode(value)
+    out.append(data_type)
+    out.extend(data)
+
+def encode(value):
+    """Return (data_type, data) for a bytes, str, bool, int, float, None,
+    list, tuple or dict value."""
+    if value is None:
+        return TYPE_NONE, b""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return TYPE_BYTES, _with_length(value)
+    if isinstance(value, str):
+        return TYPE_STR, _with_length(value.encode("utf-8"))
+    # bool is checked before int since it is also an int.
+    if isinstance(value, bool):
+        return TYPE_BOOL, bytes((1 if value else 0,))
+    if isinstance(value, int):
+        return TYPE_INT, struct.pack("<q", value)
+    if isinstance(value, float):
+        return TYPE_FLOAT, struct.pack("<d", value)
+    if isinstance(value, (list, tuple)):
+        out = _count(len(value))
+        for item in value:
+            _encode_item(out, item)
+        return TYPE_LIST, out
+    if isinstance(value, dict):
+        out = _count(len(value))
+        for key, item in value.items():
+            if not isinstance(key, (str, int)) or isinstance(key, bool):
+                raise NVMCodecException(f"Unsupported dict key type: {type(key)}")
+            _encode_item(out, key)
+            _encode_item(out, item)
+        return TYPE_DICT, out
+    raise NVMCodecException(f"Unsupported type for NVM encoding: {type(value)}")
+
+def _unpack(fmt: str, size: int, view, offset: int):
+    if offset + size > len(view):
+        raise NVMCodecException("Truncated value")
+    return struct.unpack_from(fmt, view, offset)[0]
+
+def _decode_at(data_type: int, view, offset: int):
+    """Decode one value starting at `offset`, returns (value, end offset)."""
+    if data_type == TYPE_BYTES or data_type == TYPE_STR:
+        length = _unpack(_LENGTH, _LENGTH_SIZE, view, offset)
+        start = offset + _LENGTH_SIZE
+        payload = view[start:start + length]
+        if len(payload) != length:
+            raise NVMCodecException("Truncated value")
+        if data_type == TYPE_STR:
+            return str(payload, "utf-8"), start + length
+        return bytes(payload), start + length
+
+    if data_type == TYPE_BOOL:
+        return view[offset] != 0, offset + 1
+
+    if data_type == TYPE_INT:
+        return _unpack("<q", 8, view, offset), offset + 8
+
+    if data_type == TYPE_FLOAT:
+        return _unpack("<d", 8, view, offset), offset + 8
+
+    if data_type == TYPE_NONE:
+        return None, offset
+
+    if data_type == TYPE_LIST or data_type == TYPE_DICT:
+        count = _unpack(_LENGTH, _LENGTH_SIZE, view, offset)
+        offset += _LENGTH_SIZE
+        if data_type == TYPE_LIST:
+            items = []
+            for _ in range(count):
+                item, offset = _decode_at(view[offset], view, offset + 1)
+                items.append(item)
+            return items, offset
+        items = {}
+        for _ in range(count):
+            key, offset = _decode_at(view[offset], view, offset + 1)
+            items[key], offset = _decode_at(view[offset], view, offset + 1)
+        return items, offset
+
+    raise NVMCodecException(f"Unrecognized data_type: {data_type}")
+
+def decode(data_type: int, data):
+    """Decode data written by encode(). `data` may be any buffer, it is only
+    read through memoryview slices."""
+    try:
+        return _decode_at(data_type, memoryview(data), 0)[0]
+    except IndexError:
+        raise NVMCodecException("Truncated value")
+
+def payload_span(data_type: int, header):
+    """(offset, length) of the raw bytes of a TYPE_BYTES or TYPE_STR value,
+    given at least its first two bytes."""
+    if data_type != TYPE_BYTES and data_type != TYPE_STR:
+        raise NVMCodecException(f"Not a bytes or str value: {data_type}")
+    return _LENGTH_SIZE, _unpack(_LENGTH, _LENGTH_SIZE, memoryview(header), 0)
@@ -0,0 +1,509 @@
+import struct
+
+from binascii import crc32
+from time import monotonic_ns
+from badge.log import log
+from memory_block import MemoryBlockListException
+from microcontroller import nvm as board_NVM
+
+###############################################################################
+# Log structured NVM store
+#
+#   [0:9]    header   -> magic "logfs", version, segment size, segment count
+#   [9:]     segments -> "sg" and a sequence number, then records
+#
+# Records are only ever appended to the newest (head) segment:
+#
+#   <B kind> <B data type> <B name length> <H value length> <I crc> name value
+#
+# PUT saves a value, DEL is a tombstone for a name and BATCH holds several PUT
+# and DEL records in its value so they land with a single crc checked write.
+# The crc also covers the segment's sequence number, so records left behind
+# by an earlier use of a segment never read back as valid.
+#
+# Segments are zeroed when they are opened, so a replay that stops anywhere
+# but at a zero kind byte has hit a damaged record. Everything after it in
+# that segment is lost, and if it is the head segment the rest of it is
+# zeroed so new records can never run into stale ones left behind it.
+#
+# At boot the segments are replayed in sequence order to rebuild the index.
+# New segments are opened round robin so writes move across the whole NVM
+# instead of hitting the same bytes. When fewer than GC_THRESHOLD segments
+# are free, the oldest segment has its live records copied to the head and
+# is released.
+#
+# Saves never take the last GC_RESERVE free segments. Only the collector
+# copies into them, and it always gives back the segment it released, so
+# there is always somewhere to copy the oldest segment to. Live entries are
+# also kept GC_SLACK segments short of filling the rest, so each segment the
+# collector copies wins back a useful amount instead of a few bytes. A free
+# that finds the head full drops the entry and collects until its tombstone
+# fits, or until the segment holding the entry is released and none is needed.
+
+LOG_MAGIC = b"logfs"
+_HEADER = "<5sBHB"
+_HEADER_VERSION = 1
+
+_SEGMENT = "<2sI"
+_SEGMENT_MAGIC = b"sg"
+_SEGMENT_HEADER_SIZE = struct.calcsize(_SEGMENT)
+
+_RECORD = "<BBBHI"
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD)
+_SUB_RECORD = "<BBBH"
+_SUB_RECORD_HEADER_SIZE = struct.calcsize(_SUB_RECORD)
+
+_PUT = 1
+_DEL = 2
+_BATCH = 3
+
+SEGMENTS = 8
+GC_THRESHOLD = 2
+GC_RESERVE = 1
+GC_SLACK = 1
+
+###############################################################################
+
+class _LogNVM:
+
+    def __init__(self):
+        self._NVM_SIZE = len(board_NVM)
+        self._SEGMENT_START = struct.calcsize(_HEADER)
+        self._SEGMENT_COUNT = SEGMENTS
+        self._SEGMENT_SIZE = (self._NVM_SIZE - self._SEGMENT_START) // SEGMENTS
+        self._USABLE = self._SEGMENT_SIZE - _SEGMENT_HEADER_SIZE
+        self._CAPACITY = (self._SEGMENT_COUNT - GC_RESERVE - GC_SLACK) * self._USABLE
+
+        if self._SEGMENT_SIZE > 0xFFFF:
+            raise ValueError("NVM too large for 16 bit segment sizes. Check your NVM layout.")
+
+        self.bytes_written = 0
+        self.damaged = []  # kept for fsck(), records are crc checked as they are replayed
+        self._read_in_log()
+        self._recover_reserve()
+
+    def _write(self, offset: int, data) -> None:
+        """Every write to NVM goes through here so it can be counted."""
+        board_NVM[offset:offset + len(data)] = data
+        self.bytes_written += len(data)
+
+    def _segment_base(self, segment: int) -> int:
+        return self._SEGMENT_START + segment * self._SEGMENT_SIZE
+
+    def _crc(self, seq: int, kind: int, data_type: int, name_len: int, value_len: int, body) -> int:
+        return crc32(body, crc32(struct.pack("<IBBBH", seq, kind, data_type, name_len, value_len)))
+
+    ###########################################################################
+    # Boot
+
+    def _read_in_log(self, repair: bool = True):
+        self.map = {}
+        self._batch = None
+        self._batch_depth = 0
+        self._seq = [0] * self._SEGMENT_COUNT
+        self._live = [0] * self._SEGMENT_COUNT
+        self._head = None
+        self._head_offset = 0
+        self._gc_failed = None  # (record size, live bytes) when _make_room last gave up
+
+        magic, version, segment_size, segment_count = struct.unpack(_HEADER, board_NVM[0:self._SEGMENT_START])
+        if magic != LOG_MAGIC or segment_size != self._SEGMENT_SIZE or segment_count != self._SEGMENT_COUNT:
+            log("_read_in_log:> No log found: Creating blank log")
+            self.erase_all()
+            return
+
+        for segment in range(self._SEGMENT_COUNT):
+            base = self._segment_base(segment)
+            segment_magic, seq = struct.unpack(_SEGMENT, board_NVM[base:base + _SEGMENT_HEADER_SIZE])
+            if segment_magic == _SEGMENT_MAGIC:
+                self._seq[segment] = seq
+
+        used = sorted((seq, segment) for segment, seq in enumerate(self._seq) if seq)
+        for _, segment in used:
+            end = self._replay_segment(segment)
+            self._head = segment
+            self._head_offset = end
+            if end < self._segment_base(segment) + self._SEGMENT_SIZE and board_NVM[end] != 0:
+                log(f"_read_in_log:> Segment {segment} has a damaged record at {end}")
+                self.damaged.append(f"segment {segment}")
+
+        head_end = None if self._head is None else self._segment_base(self._head) + self._SEGMENT_SIZE
+        if repair and head_end is not None and self._head_offset < head_end and board_NVM[self._head_offset] != 0:
+            self._write(self._head_offset, bytes(head_end - self._head_offset))
+
+    def _recover_reserve(self) -> None:
+        """Logs written before GC_RESERVE was kept can have every segment in
+        use, which leaves the collector nowhere to copy to. Collect what fits
+        in the head, and if that frees nothing rewrite the live entries from
+        RAM into a fresh log. A reset half way through that loses them."""
+        if self._head is None or self._free_segments():
+            return
+        while not self._free_segments():
+            if not self.compact_step():
+                break
+        if self._free_segments():
+            return
+        log("_read_in_log:> No free segment left: Rewriting the log")
+        entries = [(name, data_type, board_NVM[start:stop]) for name, (start, stop, data_type, _) in self.map.items()]
+        self.erase_all()
+        for name, data_type, data in entries:
+            self._put(name, name.encode("utf-8"), data, data_type)
+
+    def _records(self, segment: int):
+        """Yield (kind, data_type, name, value_start, value_stop) for every valid
+        record in a segment, BATCH records already split up. Stops at the first
+        record that does not check out, which is the end of the segment's log.
+        The offset after the last good record is left in self._scan_end."""
+        base = self._segment_base(segment)
+        seq = self._seq[segment]
+        data = board_NVM[base:base + self._SEGMENT_SIZE]
+        position = _SEGMENT_HEADER_SIZE
+        self._scan_end = base + position
+
+        while position + _RECORD_HEADER_SIZE <= len(data):
+            kind, data_type, name_len, value_len, crc = struct.unpack_from(_RECORD, data, position)
+            if kind not in (_PUT, _DEL, _BATCH):
+                break
+            body_start = position + _RECORD_HEADER_SIZE
+            end = body_start + name_len + value_len
+            if end > len(data):
+                break
+            body = memoryview(data)[body_start:end]
+            if crc != self._crc(seq, kind, data_type, name_len, value_len, body):
+                break
+
+            if kind == _BATCH:
+                sub = body_start + name_len
+                while sub < end:
+                    sub_kind, sub_type, sub_name_len, sub_value_len = struct.unpack_from(_SUB_RECORD, data, sub)
+                    name_start = sub + _SUB_RECORD_HEADER_SIZE
+                    value_start = name_start + sub_name_len
+                    value_stop = value_start + sub_value_len
+                    name = str(memoryview(data)[name_start:value_start], "utf-8")
+                    yield sub_kind, sub_type, name, base + value_start, base + value_stop
+                    sub = value_stop
+            else:
+                value_start = body_start + name_len
+                name = str(memoryview(data)[body_start:value_start], "utf-8")
+                yield kind, data_type, name, base + value_start, base + end
+
+            position = end
+            self._scan_end = base + position
+
+    def _replay_segment(self, segment: int) -> int:
+        for kind, data_type, name, value_start, value_stop in self._records(segment):
+            self._drop_live(name)
+            if kind == _PUT:
+                self.map[name] = [value_start, value_stop, data_type, segment]
+                self._live[segment] += self._record_size(name, value_start, value_stop)
+        return self._scan_end
+
+    def fsck(self, full: bool = True, repair: bool = True) -> dict:
+        """A full check replays the log again and reports entries that no
+        longer read back the same, including ones a lost DEL brings back. Replaying already skips bad records, so the
+        repair is to keep the new index, without `repair` the old one is put back."""
+        if not full or self._batch is not None:
+            return {"checked": 0, "damaged": list(self.damaged)}
+
+        state = (self.map, self._seq, self._live, self._head, self._head_offset)
+        found_at_boot = self.damaged
+        self.damaged = []
+        self._read_in_log(repair)
+        names = set(state[0]) | set(self.map)
+        damaged = self.damaged + [name for name in names if state[0].get(name) != self.map.get(name)]
+        self.damaged = found_at_boot + self.damaged
+        if damaged and not repair:
+            self.map, self._seq, self._live, self._head, self._head_offset = state
+        return {"checked": len(state[0]), "damaged": damaged}
+
+    ###########################################################################
+    # Space accounting
+
+    def _record_size(self, name: str, value_start: int, value_stop: int) -> int:
+        return _RECORD_HEADER_SIZE + len(name.encode("utf-8")) + value_stop - value_start
+
+    def _drop_live(self, name: str) -> None:
+        if name in self.map:
+            value_start, value_stop, _, segment = self.map.pop(name)
+            self._live[segment] -= self._record_size(name, value_start, value_stop)
+
+    def _free_segments(self) -> int:
+        return self._seq.count(0)
+
+    def _head_room(self) -> int:
+        if self._head is None:
+            return 0
+        return self._segment_base(self._head) + self._SEGMENT_SIZE - self._head_offset
+
+    def _dead_bytes(self) -> int:
+        """Bytes the collector could win back outside the head."""
+        return sum(self._USABLE - live for segment, live in enumerate(self._live) if self._seq[segment] and segment != self._head)
+
+    def free_bytes(self) -> int:
+        return max(0, self._CAPACITY - self.live_bytes())
+
+    def live_bytes(self) -> int:
+        return sum(self._live)
+
+    def record_size(self, name: str, length: int) -> int:
+        """NVM bytes an entry with a `length` byte value takes up."""
+        return _RECORD_HEADER_SIZE + len(name.encode("utf-8")) + length
+
+    def entry_size(self, name: str) -> int:
+        return self._record_size(name, *self.map[name][:2])
+
+    ###########################################################################
+    # Writing
+
+    def erase_all(self) -> None:
+        """Write a blank header and drop every segment."""
+        self._write(0, struct.pack(_HEADER, LOG_MAGIC, _HEADER_VERSION, self._SEGMENT_SIZE, self._SEGMENT_COUNT))
+        for segment in range(self._SEGMENT_COUNT):
+            self._write(self._segment_base(segment), bytes(len(_SEGMENT_MAGIC)))
+        self.map = {}
+        self._seq = [0] * self._SEGMENT_COUNT
+        self._live = [0] * self._SEGMENT_COUNT
+        self._head = None
+        self._head_offset = 0
+        self._gc_failed = None
+
+    def _open_segment(self) -> None:
+        """Move the head to the next free segment after the current one."""
+        start = 0 if self._head is None else self._head + 1
+        for i in range(self._SEGMENT_COUNT):
+            segment = (start + i) % self._SEGMENT_COUNT
+            if not self._seq[segment]:
+                break
+        else:
+            raise MemoryBlockListException("Not enough space in memory to store data.")
+
+        seq = max(self._seq) + 1
+        base = self._segment_base(segment)
+        self._write(base, struct.pack(_SEGMENT, _SEGMENT_MAGIC, seq) + bytes(self._USABLE))
+        self._seq[segment] = seq
+        self._head = segment
+        self._head_offset = base + _SEGMENT_HEADER_SIZE
+
+    def _make_room(self, size: int) -> None:
+        """Make sure a record of `size` bytes can be appended to the head
+        without opening one of the GC_RESERVE segments."""
+        if size > self._USABLE:
+            raise MemoryBlockListException(f"Record of {size} bytes is larger than a segment.")
+        if size <= self._head_room():
+            return
+        # Don't wear the NVM moving segments around when it can't work, or
+        # did not work for a record this size since anything was freed
+        failed = self._gc_failed
+        if failed is not None and size >= failed[0] and self.live_bytes() >= failed[1]:
+            raise MemoryBlockListException("Not enough space in memory to store data.")
+        for _ in range(self._SEGMENT_COUNT):
+            if size > self._head_room() + self._dead_bytes() and self._free_segments() <= GC_RESERVE:
+                break
+            if size <= self._head_room():
+                return
+            if self._free_segments() > GC_RESERVE:
+                self._open_segment()
+                return
+            # save_data() already checked the live bytes fit, so a full round
+            # of the collector wins back every dead byte there is
+            if not self.compact_step(force=True):
+                break
+        if size > self._head_room():
+            self._gc_failed = (size, self.live_bytes())
+            raise MemoryBlockListException("Not enough space in memory to store data.")
+
+    def _append(self, kind: int, data_type: int, name_bytes: bytes, value) -> int:
+        """Append one record to the head and return the address of its value."""
+        size = _RECORD_HEADER_SIZE + len(name_bytes) + len(value)
+        if size > self._head_room():
+            self._open_segment()
+        record = bytearray(size)
+        record[_RECORD_HEADER_SIZE:_RECORD_HEADER_SIZE + len(name_bytes)] = name_bytes
+        record[_RECORD_HEADER_SIZE + len(name_bytes):] = value
+        crc = self._crc(self._seq[self._head], kind, data_type, len(name_bytes), len(value), memoryview(record)[_RECORD_HEADER_SIZE:])
+        struct.pack_into(_RECORD, record, 0, kind, data_type, len(name_bytes), len(value), crc)
+
+        start = self._head_offset
+        self._write(start, record)
+        self._head_offset += size
+        return start + _RECORD_HEADER_SIZE + len(name_bytes)
+
+    def _put(self, name: str, name_bytes: bytes, data, data_type: int) -> None:
+        value_start = self._append(_PUT, data_type, name_bytes, data)
+        self._drop_live(name)
+        self.map[name] = [value_start, value_start + len(data), data_type, self._head]
+        self._live[self._head] += _RECORD_HEADER_SIZE + len(name_bytes) + len(data)
+
+    def save_data(self, name: str, data, data_type: int):
+        """Append a PUT record for the data to the head of the log."""
+        if self._batch is not None:
+            self._batch[name] = (bytes(data), data_type)
+            return
+
+        name_bytes = name.encode("utf-8")
+        if len(name_bytes) > 0xFF:
+            raise ValueError(f"Name too long: '{name}'")
+        size = _RECORD_HEADER_SIZE + len(name_bytes) + len(data)
+
+        old = self._record_size(name, *self.map[name][:2]) if name in self.map else 0
+        if size > old and self.live_bytes() - old + size > self._CAPACITY:
+            raise MemoryBlockListException("Not enough space in memory to store data.")
+
+        self._make_room(size)
+        self._put(name, name_bytes, data, data_type)
+
+    def free_data(self, name: str):
+        """Append a DEL record (tombstone) for the name."""
+        if self._batch is not None:
+            self._batch[name] = (None, None)
+            return
+
+        if name not in self.map:
+            log(f"free_data:> Data with name '{name}' not found in map.")
+            return
+
+        name_bytes = name.encode("utf-8")
+        size = _RECORD_HEADER_SIZE + len(name_bytes)
+        entry = self.map[name]
+        segment = entry[3]
+        seq = self._seq[segment]
+        # Dropped first so the collector doesn't copy it. If a reset comes
+        # before the tombstone is written the entry is simply still there.
+        self._drop_live(name)
+        # Collecting full segments too, every segment gets its turn within
+        # two rounds, so the one holding the entry is released at the latest.
+        for _ in range(2 * self._SEGMENT_COUNT):
+            if size <= self._head_room() or self._seq[segment] != seq:
+                break
+            if self._free_segments() > GC_RESERVE:
+                self._open_segment()
+            elif not self.compact_step(force=True):
+                break
+        if self._seq[segment] == seq:
+            if size > self._head_room():
+                self.map[name] = entry
+                self._live[segment] += self._record_size(name, *entry[:2])
+                raise MemoryBlockListException("Not enough space in memory to free data.")
+            self._append(_DEL, 0, name_bytes, b"")
+
+        log(f"free_data:> Data with name '{name}' has been freed and removed from map.")
+
+    def locate(self, name: str):
+        """(buffer, value start, value stop, data type) for an entry, without
+        copying its value out of NVM."""
+        if self._batch is not None and name in self._batch:
+            data, data_type = self._batch[name]
+            if data is None:
+                raise ValueError(f"No entry found for '{name}' in map.")
+            return data, 0, len(data), data_type
+        if name not in self.map:
+            raise ValueError(f"No entry found for '{name}' in map.")
+        value_start, value_stop, data_type, _ = self.map[name]
+        return board_NVM, value_start, value_stop, data_type
+
+    def read_data(self, name: str):
+        source, start, stop, data_type = self.locate(name)
+        return source[start:stop], data_type
+
+    def check_data(self, name: str) -> None:
+        """Records are crc checked as the log is replayed at boot."""
+
+    ###########################################################################
+    # Batches
+
+    def begin_batch(self) -> None:
+        """Stage saves and frees in RAM until the outermost end_batch()."""
+        if self._batch_depth == 0:
+            self._batch = {}
+        self._batch_depth += 1
+
+    def end_batch(self, commit: bool = True) -> None:
+        self._batch_depth -= 1
+        if self._batch_depth > 0:
+            return
+        staged = self._batch
+        self._batch = None
+        if commit and staged:
+            self._commit_batch(staged)
+
+    def _commit_batch(self, staged: dict) -> None:
+        """Append every staged change as one BATCH record."""
+        value = bytearray()
+        for name, (data, data_type) in staged.items():
+            name_bytes = name.encode("utf-8")
+            if data is None:
+                value += struct.pack(_SUB_RECORD, _DEL, 0, len(name_bytes), 0)
+                value += name_bytes
+            else:
+                value += struct.pack(_SUB_RECORD, _PUT, data_type, len(name_bytes), len(data))
+                value += name_bytes
+                value += data
+
+        size = _RECORD_HEADER_SIZE + len(value)
+        old = sum(self._record_size(name, *self.map[name][:2]) for name in staged if name in self.map)
+        if size > old and self.live_bytes() - old + size > self._CAPACITY:
+            raise MemoryBlockListException("Not enough space in memory to store batch.")
+        self._make_room(size)
+        value_start = self._append(_BATCH, 0, b"", value)
+
+        position = 0
+        for name, (data, data_type) in staged.items():
+            position += _SUB_RECORD_HEADER_SIZE + len(name.encode("utf-8"))
+            self._drop_live(name)
+            if data is not None:
+                self.map[name] = [value_start + position, value_start + position + len(data), data_type, self._head]
+                self._live[self._head] += self._record_size(name, value_start + position, value_start + position + len(data))
+                position += len(data)
+
+    ###########################################################################
+    # Garbage collection
+
+    def _oldest_segment(self):
+        used = [(seq, segment) for segment, seq in enumerate(self._seq) if seq and segment != self._head]
+        return min(used)[1] if used else None
+
+    def compact_step(self, force: bool = False) -> bool:
+        """Copy the live records of the oldest segment to the head and release
+        it. Returns False if there was nothing that could be reclaimed, unless
+        `force` moves a segment without dead records anyway."""
+        victim = self._oldest_segment()
+        if victim is None or (self._live[victim] >= self._USABLE and not force):
+            return False
+        if self._live[victim] > self._head_room() and not self._free_segments():
+            return False
+
+        live = []
+        for kind, data_type, name, value_start, value_stop in self._records(victim):
+            entry = self.map.get(name)
+            if kind == _PUT and entry is not None and entry[0] == value_start and entry[3] == victim:
+                live.append((name, data_type, board_NVM[value_start:value_stop]))
+
+        for name, data_type, data in live:
+            self._put(name, name.encode("utf-8"), data, data_type)
+
+        # Once the copies are on NVM the old segment can go.
+        self._write(self._segment_base(victim), bytes(len(_SEGMENT_MAGIC)))
+        self._seq[victim] = 0
+        self._live[victim] = 0
+        return True
+
+    def needs_compaction(self) -> bool:
+        return self._free_segments() < GC_THRESHOLD and self._oldest_segment() is not None
+
+    def compact_memory(self, budget_ms: int = None) -> bool:
+        """Without a budget, release every segment that holds dead records.
+        With one, collect segments until GC_THRESHOLD are free or budget_ms
+        have passed. Returns True when nothing more needs collecting."""
+        if budget_ms is None:
+            for _ in range(self._SEGMENT_COUNT):
+                if not self.compact_step():
+                    break
+            return True
+
+        deadline = monotonic_ns() + budget_ms * 1_000_000
+        while self.needs_compaction():
+            if not self.compact_step():
+                return False
+            if monotonic_ns() >= deadline:
+                break
+        return not self.needs_compaction()
@@ -0,0 +1,87 @@
+"""Render the badge's boot profile as a timeline.
+
+On the badge, turn profiling on once from the REPL, then reboot a few times:
+
+    >>> from badge.profile import profile_enable, dump
+    >>> profile_enable()
+    ...
+    >>> dump()
+
+Save the serial output of dump() to a file (other lines are ignored) and
+
+    python3 tools/boot_timeline.py serial.txt [--boots 3]
+
+or read the phases straight out of an NVM image written by nvm_sim:
+
+    python3 tools/boot_timeline.py --nvm nvm.img
+
+Each phase is shown with the time since power on, how long it took until the
+next phase, a bar of that length and the free memory when it started.
+"""
+
+import argparse
+import sys
+
+BAR_WIDTH = 40
+
+###############################################################################
+
+def parse_dump(lines):
+    """(boot, name, ms, mem_free) for every profile: line."""
+    result = []
+    for line in lines:
+        line = line.strip()
+        if not line.startswith("profile:"):
+            continue
+        boot, name, ms, mem_free = line[len("profile:"):].split(",")
+        result.append((int(boot), name, int(ms), int(mem_free)))
+    return result
+
+def read_nvm(path: str):
+    import nvm_sim
+
+    nvm_sim.install(path=path)
+    nvm_sim.boot()
+    from badge.profile import records
+    return records()
+
+def render(records, boots: int, out=sys.stdout) -> None:
+    by_boot = {}
+    for boot, name, ms, mem_free in records:
+        by_boot.setdefault(boot, []).append((name, ms, mem_free))
+
+    for boot in list(by_boot)[-boots:]:
+        phases = by_boot[boot]
+        start, end = phases[0][1], phases[-1][1]
+        print(f"boot {boot}: {len(phases)} phases, {end - start} ms from {phases[0][0]} to {phases[-1][0]}", file=out)
+        scale = BAR_WIDTH / max(end - start, 1)
+        for i, (name, ms, mem_free) in enumerate(phases):
+            took = phases[i + 1][1] - ms if i + 1 < len(phases) else 0
+            offset = int((ms - start) * scale)
+            bar = " " * offset + "#" * max(int(took * scale), 1 if took else 0)
+            print(f"  {ms:>8} ms  {name:<8} {took:>6} ms |{bar:<{BAR_WIDTH}}| {mem_free:>7} free", file=out)
+        print(file=out)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dump", nargs="?", help="saved output of badge.profile.dump(), stdin if left out")
+    parser.add_argument("--nvm", help="read an NVM image file instead")
+    parser.add_argument("--boots", type=int, default=3, help="how many of the last boots to show")
+    args = parser.parse_args()
+
+    if args.nvm:
+        records = read_nvm(args.nvm)
+    elif args.dump:
+        with open(args.dump) as f:
+            records = parse_dump(f)
+    else:
+        records = parse_dump(sys.stdin)
+
+    if not records:
+        print("No profile records found", file=sys.stderr)
+        return 1
+    render(records, args.boots)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Write the launcher's app index on the host.
+
+    python3 tools/build_app_index.py [--apps /Volumes/CIRCUITPY/apps]
+
+The launcher runs with the root filesystem read only, so it can't save the
+index it builds and would scan every app on every boot until the App Store
+saved one. cp_src_to_badge.sh runs this once the apps are copied, so the
+badge starts out with an index. It makes the same records as
+badge.app.scan_app(), with paths as the badge sees them.
+
+The badge can't be asked for the size and mtime of its apps directory from
+here, so the index is written without them. The launcher then only checks
+the list of app names, and still rebuilds the index when an app is added or
+removed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import zlib
+
+# Must match badge.app
+APPS_DIR = "/apps"
+DEFAULT_ICON = "/badge/img/app-default.bmp"
+APP_INDEX_VERSION = 3
+
+###############################################################################
+
+def app_names(apps_dir: str):
+    return sorted(e for e in os.listdir(apps_dir) if not e.startswith("_") and not e.startswith("."))
+
+def _load_json(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def file_crc(path: str) -> int:
+    with open(path, "rb") as f:
+        return zlib.crc32(f.read())
+
+def scan_app(apps_dir: str, name: str) -> dict:
+    local = os.path.join(apps_dir, name)
+    appdir = f"{APPS_DIR}/{name}"
+    has_icon = os.path.isfile(os.path.join(local, "icon.bmp"))
+    return {
+        "dir": appdir,
+        "code": f"{appdir}/code.py" if os.path.isfile(os.path.join(local, "code.py")) else None,
+        "icon": f"{appdir}/icon.bmp" if has_icon else DEFAULT_ICON,
+        "icon_crc": file_crc(os.path.join(local, "icon.bmp")) if has_icon else None,
+        "meta": _load_json(os.path.join(local, "metadata.json")),
+        "boot": _load_json(os.path.join(local, "boot.json")),
+    }
+
+def build(apps_dir: str, out: str = None) -> dict:
+    names = app_names(apps_dir)
+    records = [scan_app(apps_dir, name) for name in names if os.path.isdir(os.path.join(apps_dir, name))]
+    index = {"version": APP_INDEX_VERSION, "names": names, "stamp": None, "apps": records}
+    with open(out or os.path.join(apps_dir, ".index"), "w") as f:
+        json.dump(index, f)
+    return index
+
+def main() -> int:
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--apps", default=os.path.join(root, "apps"), help="the badge's apps directory")
+    parser.add_argument("--out", help="where to write the index, defaults to <apps>/.index")
+    args = parser.parse_args()
+
+    index = build(args.apps, args.out)
+    print(f"{len(index['apps'])} apps indexed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Build a smaller copy of src/ to put on the badge.
+
+    python3 tools/build_deploy.py [--src src] [--out build/deploy] [--mpy]
+    tools/cp_src_to_badge.sh build/deploy
+
+CircuitPython compiles every .py it imports on the badge, and comments and
+docstrings cost parse time and heap there. Each .py is parsed on the host and
+written back without comments, docstrings or blank lines, with arithmetic on
+literals folded (32 * 1024 becomes 32768). Everything else is copied as is.
+A file this Python can't parse is copied unchanged with a warning.
+
+With --mpy, modules other than boot.py and code.py (which CircuitPython runs
+by name) are compiled to .mpy with mpy-cross, so the badge doesn't parse them
+at all. mpy-cross must be on PATH and match the badge's CircuitPython version.
+
+Modules are not concatenated: other modules and the launcher's in process
+runner find them by name, so merging them would change behaviour.
+
+A report of the bytes saved per module is printed at the end.
+"""
+
+import argparse
+import ast
+import os
+import shutil
+import subprocess
+import sys
+
+# Run by name, so never compiled to .mpy
+ENTRY_POINTS = ("boot.py", "code.py", "main.py")
+SKIP_DIRS = ("__pycache__", ".git")
+
+# Folded values larger than this are left as expressions
+MAX_FOLDED_LEN = 64
+
+###############################################################################
+
+def _is_docstring(node) -> bool:
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+class Minifier(ast.NodeTransformer):
+    """Drops bare string statements, docstrings included, and folds
+    arithmetic on number and string literals."""
+
+    def _strip_body(self, node):
+        self.generic_visit(node)
+        for field in ("body", "orelse", "finalbody"):
+            body = getattr(node, field, None)
+            if not isinstance(body, list) or not body:
+                continue
+            body = [stmt for stmt in body if not _is_docstring(stmt)]
+            if not body and field == "body":
+                body = [ast.Pass()]
+            setattr(node, field, body)
+        return node
+
+    visit_Module = _strip_body
+    visit_FunctionDef = _strip_body
+    visit_AsyncFunctionDef = _strip_body
+    visit_ClassDef = _strip_body
+    visit_If = _strip_body
+    visit_For = _strip_body
+    visit_While = _strip_body
+    visit_AsyncFor = _strip_body
+    visit_With = _strip_body
+    visit_AsyncWith = _strip_body
+    visit_Try = _strip_body
+    visit_ExceptHandler = _strip_body
+
+    def _fold(self, node):
+        self.generic_visit(node)
+        operands = [node.operand] if isinstance(node, ast.UnaryOp) else [node.left, node.right]
+        if not all(isinstance(o, ast.Constant) and type(o.value) in (int, float, str) for o in operands):
+            return node
+        try:
+            value = eval(compile(ast.Expression(node), "<fold>", "eval"), {"__builtins__": {}})
+        except Exception:
+            return node
+        if len(repr(value)) > MAX_FOLDED_LEN:
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    visit_BinOp = _fold
+    visit_UnaryOp = _fold
+
+def minify(source: str, filename: str) -> str:
+    tree = Minifier().visit(ast.parse(source, filename))
+    ast.fix_missing_locations(tree)
+    result = ast.unparse(tree)
+    return result + "\n" if result else ""
+
+###############################################################################
+
+def mpy_cross(path: str) -> str:
+    mpy = path[:-3] + ".mpy"
+    subprocess.run(["mpy-cross", "-o", mpy, path], check=True)
+    os.remove(path)
+    return mpy
+
+def build(src: str, out: str, use_mpy: bool = False):
+    """Write the deploy tree to `out`, returns [(module, before, after)]."""
+    if use_mpy and shutil.which("mpy-cross") is None:
+        raise SystemExit("mpy-cross not found on PATH")
+    if os.path.exists(out):
+        shutil.rmtree(out)
+
+    report = []
+    for root, dirs, files in os.walk(src):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        target_dir = os.path.join(out, os.path.relpath(root, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            target = os.path.join(target_dir, name)
+            if not name.endswith(".py"):
+                shutil.copy2(path, target)
+                continue
+
+            with open(path, encoding="utf-8") as f:
+                source = f.read()
+            try:
+                result = minify(source, path)
+            except SyntaxError as e:
+                print(f"warning: {path}: {e.msg} on line {e.lineno}, copied unchanged", file=sys.stderr)
+                result = source
+            with open(target, "w", encoding="utf-8") as f:
+                f.write(result)
+            if use_mpy and name not in ENTRY_POINTS:
+                target = mpy_cross(target)
+            report.append((os.path.relpath(path, src), len(source.encode()), os.path.getsize(target)))
+    return report
+
+def print_report(report, out=sys.stdout) -> None:
+    width = max(len(module) for module, _, _ in report)
+    for module, before, after in sorted(report, key=lambda r: r[1] - r[2], reverse=True):
+        print(f"{module:<{width}} {before:>8} -> {after:>8}  {before - after:>7} saved", file=out)
+    before = sum(r[1] for r in report)
+    after = sum(r[2] for r in report)
+    print(f"{'total':<{width}} {before:>8} -> {after:>8}  {before - after:>7} saved ({(before - after) * 100 // max(before, 1)}%)", file=out)
+
+def main() -> int:
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--src", default=os.path.join(root, "src"))
+    parser.add_argument("--out", default=os.path.join(root, "build", "deploy"))
+    parser.add_argument("--mpy", action="store_true", help="compile modules with mpy-cross")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.out) == os.path.abspath(args.src):
+        parser.error("--out must not be --src")
+    print_report(build(args.src, args.out, args.mpy))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""Pack every app icon into one indexed BMP for the launcher.
+
+    python3 tools/build_icon_atlas.py [--apps src/apps] [--out DIR] [--default src/badge/img/app-default.bmp]
+
+Writes <out>/.atlas.bmp, a single 8 bit BMP with all of the 128x76 icons
+stacked top to bottom and one shared palette, and <out>/.atlas.json with the
+tile index of each app. The launcher shows the atlas through one TileGrid, so
+moving to another app only changes the tile index instead of opening a new
+bitmap. Apps missing from the atlas, or whose icon.bmp is no longer the one
+it was built from (by crc32), fall back to loading their own icon.
+
+Icons may be 1, 4, 8, 16, 24 or 32 bit BMPs. Colors are reduced to what the
+LCD can show (RGB565) and, if there are still more than 256, median cut down
+to 256. Only the standard library is needed.
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+
+TILE_WIDTH = 128
+TILE_HEIGHT = 76
+PAD_COLOR = 0x3453FF  # SITE_BLUE, the launcher background
+PALETTE_SIZE = 256
+
+###############################################################################
+# Reading
+
+def _mask_shift(mask: int):
+    if not mask:
+        return 0, 0
+    shift = 0
+    while not mask >> shift & 1:
+        shift += 1
+    return shift, (mask >> shift).bit_length()
+
+def _channel(value: int, mask: int) -> int:
+    shift, bits = _mask_shift(mask)
+    if not bits:
+        return 0
+    return ((value & mask) >> shift) * 255 // ((1 << bits) - 1)
+
+def read_bmp(path: str):
+    """Return (width, height, rows) with rows top to bottom of 0xRRGGBB ints."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:2] != b"BM":
+        raise ValueError(f"{path} is not a BMP")
+    offset = struct.unpack_from("<I", data, 10)[0]
+    header_size, width, height, _, bpp, compression = struct.unpack_from("<IiiHHI", data, 14)
+    colors_used = struct.unpack_from("<I", data, 46)[0] if header_size >= 40 else 0
+    bottom_up = height > 0
+    height = abs(height)
+
+    palette = []
+    if bpp <= 8:
+        count = colors_used or 1 << bpp
+        start = 14 + header_size
+        for i in range(count):
+            b, g, r, _ = data[start + i * 4:start + i * 4 + 4]
+            palette.append(r << 16 | g << 8 | b)
+
+    if compression == 3:  # BI_BITFIELDS, the masks follow a 40 byte header
+        masks = struct.unpack_from("<III", data, 14 + 40)
+    elif bpp == 16:
+        masks = (0x7C00, 0x03E0, 0x001F)
+    else:
+        masks = (0xFF0000, 0x00FF00, 0x0000FF)
+    if compression not in (0, 3):
+        raise ValueError(f"{path} uses unsupported BMP compression {compression}")
+
+    stride = (width * bpp + 31) // 32 * 4
+    rows = []
+    for y in range(height):
+        row_start = offset + (height - 1 - y if bottom_up else y) * stride
+        row = []
+        for x in range(width):
+            if bpp <= 8:
+                bit = x * bpp
+                byte = data[row_start + bit // 8]
+                index = byte >> (8 - bpp - bit % 8) & ((1 << bpp) - 1)
+                row.append(palette[index])
+                continue
+            size = bpp // 8
+            value = int.from_bytes(data[row_start + x * size:row_start + x * size + size], "little")
+            row.append(_channel(value, masks[0]) << 16 | _channel(value, masks[1]) << 8 | _channel(value, masks[2]))
+        rows.append(row)
+    return width, height, rows
+
+def to_tile(rows, width: int, height: int, pad: int):
+    """Fit an icon into a TILE_WIDTH x TILE_HEIGHT tile at its top left corner,
+    where the launcher shows smaller icons, padding with `pad`."""
+    tile = []
+    for y in range(TILE_HEIGHT):
+        row = rows[y][:TILE_WIDTH] if y < height else []
+        tile.append(row + [pad] * (TILE_WIDTH - len(row)))
+    return tile
+
+###############################################################################
+# Palette
+
+def rgb565(color: int) -> int:
+    """Round a color to what the RGB565 LCD shows, back in 0xRRGGBB."""
+    r = (color >> 16 & 0xFF) >> 3
+    g = (color >> 8 & 0xFF) >> 2
+    b = (color & 0xFF) >> 3
+    return (r * 255 // 31) << 16 | (g * 255 // 63) << 8 | (b * 255 // 31)
+
+def _rgb(color: int):
+    return color >> 16 & 0xFF, color >> 8 & 0xFF, color & 0xFF
+
+def median_cut(counts: dict, size: int):
+    """Reduce {color: pixel count} to at most `size` colors."""
+    boxes = [list(counts)]
+    while len(boxes) < size:
+        # Split the box with the widest channel range
+        best = None
+        for i, box in enumerate(boxes):
+            if len(box) < 2:
+                continue
+            for channel in range(3):
+                values = [_rgb(color)[channel] for color in box]
+                spread = max(values) - min(values)
+                if best is None or spread > best[0]:
+                    best = (spread, i, channel)
+        if best is None:
+            break
+        _, i, channel = best
+        box = sorted(boxes.pop(i), key=lambda color: _rgb(color)[channel])
+        total = sum(counts[color] for color in box)
+        running = 0
+        for split, color in enumerate(box):
+            running += counts[color]
+            if running * 2 >= total:
+                break
+        split = min(max(split, 1), len(box) - 1)
+        boxes += [box[:split], box[split:]]
+
+    palette = []
+    for box in boxes:
+        weight = sum(counts[color] for color in box)
+        average = [sum(_rgb(color)[c] * counts[color] for color in box) // weight for c in range(3)]
+        palette.append(average[0] << 16 | average[1] << 8 | average[2])
+    return palette
+
+def nearest(palette, color: int) -> int:
+    r, g, b = _rgb(color)
+    best = None
+    for index, entry in enumerate(palette):
+        er, eg, eb = _rgb(entry)
+        distance = (r - er) ** 2 + (g - eg) ** 2 + (b - eb) ** 2
+        if best is None or distance < best[0]:
+            best = (distance, index)
+    return best[1]
+
+###############################################################################
+# Writing
+
+def write_bmp(path: str, width: int, height: int, pixels, palette) -> None:
+    """Write an 8 bit indexed, bottom up BMP. `pixels` is rows of indexes."""
+    stride = (width + 3) // 4 * 4
+    palette_bytes = b"".join(struct.pack("<BBBB", color & 0xFF, color >> 8 & 0xFF, color >> 16 & 0xFF, 0)
+                             for color in palette + [0] * (PALETTE_SIZE - len(palette)))
+    offset = 14 + 40 + len(palette_bytes)
+    image = bytearray()
+    for row in reversed(pixels):
+        image += bytes(row) + bytes(stride - width)
+
+    with open(path, "wb") as f:
+        f.write(b"BM" + struct.pack("<IHHI", offset + len(image), 0, 0, offset))
+        f.write(struct.pack("<IiiHHIIiiII", 40, width, height, 1, 8, 0, len(image), 2835, 2835, PALETTE_SIZE, 0))
+        f.write(palette_bytes)
+        f.write(image)
+
+###############################################################################
+
+def file_crc(path: str) -> int:
+    with open(path, "rb") as f:
+        return zlib.crc32(f.read())
+
+def build(apps_dir: str, default_icon: str, out_dir: str = None, pad: int = PAD_COLOR) -> dict:
+    out_dir = out_dir or apps_dir
+    icons = []
+    for name in sorted(os.listdir(apps_dir)):
+        icon = os.path.join(apps_dir, name, "icon.bmp")
+        if not name.startswith((".", "_")) and os.path.isfile(icon):
+            icons.append((name, icon))
+    icons.append((None, default_icon))
+
+    tiles = []
+    for _, icon in icons:
+        width, height, rows = read_bmp(icon)
+        tiles.append(to_tile(rows, width, height, pad))
+
+    counts = {}
+    for tile in tiles:
+        for row in tile:
+            for color in row:
+                color = rgb565(color)
+                counts[color] = counts.get(color, 0) + 1
+    palette = list(counts) if len(counts) <= PALETTE_SIZE else median_cut(counts, PALETTE_SIZE)
+
+    lookup = {}
+    pixels = []
+    for tile in tiles:
+        for row in tile:
+            indexes = []
+            for color in row:
+                color = rgb565(color)
+                if color not in lookup:
+                    lookup[color] = nearest(palette, color)
+                indexes.append(lookup[color])
+            pixels.append(indexes)
+
+    atlas_path = os.path.join(out_dir, ".atlas.bmp")
+    write_bmp(atlas_path, TILE_WIDTH, TILE_HEIGHT * len(tiles), pixels, palette)
+
+    atlas = {
+        "tile_width": TILE_WIDTH,
+        "tile_height": TILE_HEIGHT,
+        # app dir name: [tile index, crc32 of the icon.bmp it was built from]
+        "tiles": {name: [i, file_crc(icon)] for i, (name, icon) in enumerate(icons) if name},
+        "default": len(icons) - 1,
+    }
+    with open(os.path.join(out_dir, ".atlas.json"), "w") as f:
+        json.dump(atlas, f)
+    return {"icons": len(tiles), "colors": len(counts), "palette": len(palette), "path": atlas_path}
+
+def main() -> int:
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--apps", default=os.path.join(root, "apps"))
+    parser.add_argument("--out", help="where to write the atlas, defaults to --apps")
+    parser.add_argument("--default", default=os.path.join(root, "badge", "img", "app-default.bmp"))
+    args = parser.parse_args()
+
+    result = build(args.apps, args.default, args.out)
+    print(f"{result['path']}: {result['icons']} icons, {result['colors']} colors in {result['palette']} palette entries")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
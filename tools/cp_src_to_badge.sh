@@ -1,6 +1,9 @@
 #!/bin/bash
 
 # Usage: ./copy_files.sh /path/to/base_dir /path/to/dest_dir
+#
+# base_dir may be src/ or, for faster imports on the badge, the tree built by
+#   python3 tools/build_deploy.py --out build/deploy
 
 BASE_DIR="$1"
 
@@ -47,6 +50,13 @@ cp -r "${BASE_DIR}/apps/appStore/"* "${CP_BASE_DIR}apps/appStore/."
 echo "status: Copying schedule app"
 cp -r "${BASE_DIR}/apps/schedule/"* "${CP_BASE_DIR}apps/schedule/."
 
+# Only from the apps copied above, so the palette is theirs alone
+echo "status: Building icon atlas"
+python3 "$(dirname "$0")/build_icon_atlas.py" --apps "${CP_BASE_DIR}apps" --default "${BASE_DIR}/badge/img/app-default.bmp"
+
+echo "status: Building app index"
+python3 "$(dirname "$0")/build_app_index.py" --apps "${CP_BASE_DIR}apps"
+
 echo "status: Copying badge directory"
 cp -r "${BASE_DIR}/badge/"* "${CP_BASE_DIR}badge/."
 
@@ -0,0 +1,388 @@
+"""Benchmark and fuzz badge_nvm on the host, see nvm_sim.
+
+    python3 tools/nvm_bench.py bench [--mode slot|log] [--ops N] [--seed S]
+    python3 tools/nvm_bench.py fuzz  [--mode slot|log] [--ops N] [--seed S]
+    python3 tools/nvm_bench.py fill  [--mode slot|log] [--ops N] [--seed S]
+
+bench runs randomized workloads and reports save/open/free/compact latency,
+bytes written to NVM and how fragmented the free space ends up. fuzz runs a
+random mix of saves, frees, batches, compactions and reboots and checks the
+store against a plain dict, and the block list against the map, after every
+operation. A failing run prints its seed so it can be replayed.
+
+fill saves until the store is full, then checks that every entry can still be
+freed and that freed space can be saved into again, across reboots. --ops is
+the number of times the store is filled.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import nvm_sim
+
+WORKLOADS = {
+    # name: (number of keys, largest value in bytes, share of saves, frees, compacts)
+    "small":  (32, 24, 0.60, 0.15, 0.02),
+    "mixed":  (24, 200, 0.60, 0.15, 0.02),
+    "churn":  (6, 600, 0.75, 0.20, 0.02),
+}
+
+###############################################################################
+
+def random_value(rng: random.Random, largest: int, depth: int = 0):
+    kind = rng.randrange(8 if depth < 2 else 5)
+    if kind == 0:
+        return "x" * rng.randrange(largest)
+    if kind == 1:
+        return bytes(rng.randrange(256) for _ in range(rng.randrange(largest)))
+    if kind == 2:
+        return rng.randrange(-1 << 31, 1 << 31)
+    if kind == 3:
+        return rng.random() < 0.5
+    if kind == 4:
+        return None if rng.random() < 0.5 else rng.random()
+    count = rng.randrange(largest // 16 + 1)
+    if kind == 5:
+        return [random_value(rng, largest // 4, depth + 1) for _ in range(count)]
+    return {f"k{i}": random_value(rng, largest // 4, depth + 1) for i in range(count)}
+
+def fragmentation(badge_nvm) -> float:
+    """0 when all free space is usable by one save, towards 1 as it is
+    split up. For the log store it is the share of written bytes that are dead."""
+    store = badge_nvm._nvm
+    if badge_nvm.nvm_stats()["mode"] == badge_nvm.NVM_MODE_LOG:
+        used = sum(1 for seq in store._seq if seq) * store._USABLE - store._head_room()
+        return 1 - store.live_bytes() / used if used else 0.0
+    free = badge_nvm._mbl.free_bytes()
+    return 1 - badge_nvm._mbl.largest_free() / free if free else 0.0
+
+def open_store(mode: str, path: str = None):
+    nvm = nvm_sim.install(path=path)
+    badge_nvm = nvm_sim.boot()
+    badge_nvm.nvm_format(mode)
+    nvm.reset_counters()
+    return nvm, badge_nvm
+
+def quiet():
+    """badge_nvm logs every operation, which would swamp the timings."""
+    import badge.log
+    badge.log.log = lambda *msgs: None
+    for name in ("badge_nvm", "nvm_log"):
+        if name in sys.modules:
+            sys.modules[name].log = badge.log.log
+
+###############################################################################
+# Benchmark
+
+def percentile(samples, fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def run_workload(mode: str, workload: str, ops: int, seed: int, path: str = None) -> dict:
+    keys, largest, saves, frees, compacts = WORKLOADS[workload]
+    rng = random.Random(seed)
+    nvm, badge_nvm = open_store(mode, path)
+    quiet()
+
+    timings = {"save": [], "open": [], "free": [], "compact": []}
+    full = 0
+    for _ in range(ops):
+        name = f"key{rng.randrange(keys)}"
+        roll = rng.random()
+        start = time.perf_counter_ns()
+        try:
+            if roll < saves:
+                op = "save"
+                badge_nvm.nvm_save(name, random_value(rng, largest))
+            elif roll < saves + frees:
+                op = "free"
+                badge_nvm.nvm_free(name)
+            elif roll < saves + frees + compacts:
+                op = "compact"
+                badge_nvm.nvm_compact()
+            else:
+                op = "open"
+                try:
+                    badge_nvm.nvm_open(name)
+                except ValueError:
+                    pass
+        except (badge_nvm.MemoryBlockListException, badge_nvm.MapSizeException):
+            full += 1
+            continue
+        timings[op].append(time.perf_counter_ns() - start)
+
+    stats = badge_nvm.nvm_stats()
+    result = {
+        "mode": mode,
+        "workload": workload,
+        "bytes_written": nvm.bytes_written,
+        "writes": nvm.writes,
+        "entries": stats["entries"],
+        "free": stats["free"],
+        "fragmentation": fragmentation(badge_nvm),
+        "full": full,
+        "cache_hits": stats["cache_hits"],
+        "cache_misses": stats["cache_misses"],
+        "latency": {},
+    }
+    for op, samples in timings.items():
+        if samples:
+            result["latency"][op] = (percentile(samples, 0.5) / 1000, percentile(samples, 0.95) / 1000, max(samples) / 1000)
+    nvm.close()
+    return result
+
+def bench(args) -> int:
+    modes = [args.mode] if args.mode else ["slot", "log"]
+    for mode in modes:
+        for workload in WORKLOADS:
+            result = run_workload(mode, workload, args.ops, args.seed, args.file)
+            print(f"{mode}/{workload}: {args.ops} ops, seed {args.seed}")
+            for op, (p50, p95, worst) in result["latency"].items():
+                print(f"  {op:8} p50 {p50:8.1f}us  p95 {p95:8.1f}us  max {worst:8.1f}us")
+            print(f"  written  {result['bytes_written']} bytes in {result['writes']} writes")
+            print(f"  store    {result['entries']} entries, {result['free']} bytes free, "
+                  f"fragmentation {result['fragmentation']:.2f}, {result['full']} saves did not fit")
+            print(f"  cache    {result['cache_hits']} hits, {result['cache_misses']} misses")
+    return 0
+
+###############################################################################
+# Fuzzer
+
+class FuzzFailure(Exception): pass
+
+def check(badge_nvm, reference: dict) -> None:
+    store = badge_nvm._nvm
+    if set(store.map) != set(reference):
+        raise FuzzFailure(f"map and reference differ: {sorted(set(store.map) ^ set(reference))}")
+    if badge_nvm.nvm_keys() != sorted(reference):
+        raise FuzzFailure("nvm_keys() and the map differ")
+    for namespace in ("app/ns0/", "app/ns1/", "app/ns2/"):
+        if badge_nvm.nvm_usage(namespace) > badge_nvm.NVM_APP_QUOTA:
+            raise FuzzFailure(f"{namespace} is over its quota")
+    for name, value in reference.items():
+        stored = badge_nvm.nvm_open(name)
+        if stored != value or type(stored) is not type(value):
+            raise FuzzFailure(f"{name!r} reads back as {stored!r}, expected {value!r}")
+
+    if badge_nvm.nvm_stats()["mode"] != badge_nvm.NVM_MODE_SLOT:
+        return
+
+    # The block table has to tile the data region and agree with the map.
+    table = badge_nvm._mbl
+    position = store._DATA_START
+    used = set()
+    previous = None
+    for start, stop, block_type in table:
+        if start != position:
+            raise FuzzFailure(f"block at {start}, expected {position}")
+        if previous == block_type == 0:
+            raise FuzzFailure(f"FREE blocks not merged at {start}")
+        if block_type == 1:
+            used.add((start, stop))
+        position = stop
+        previous = block_type
+    if position != store._NVM_SIZE:
+        raise FuzzFailure(f"block table ends at {position}")
+    if used != {(entry[0], entry[1]) for entry in store.map.values()}:
+        raise FuzzFailure("USED blocks and map entries differ")
+    if store._owners != {entry[0]: name for name, entry in store.map.items()}:
+        raise FuzzFailure("reverse index and map differ")
+    free_keys = sorted(key for free in table._free for key in free)
+    free_blocks = sorted(((stop - start) << 16) | start for start, stop, block_type in table if block_type == 0)
+    if free_keys != free_blocks:
+        raise FuzzFailure("free lists and FREE blocks differ")
+
+def random_name(rng: random.Random, keys: int) -> str:
+    """Half of the names are in one of three app namespaces."""
+    key = rng.randrange(keys)
+    return f"app/ns{key % 3}/key{key}" if key % 2 else f"key{key}"
+
+def fuzz_step(rng: random.Random, badge_nvm, reference: dict, keys: int, largest: int):
+    """Do one random operation, keeping `reference` in step. Returns the
+    operation as text and badge_nvm, which is a new module after a reboot."""
+    full = (badge_nvm.MemoryBlockListException, badge_nvm.MapSizeException, badge_nvm.NVMQuotaException)
+    name = random_name(rng, keys)
+    roll = rng.random()
+
+    if roll < 0.5:
+        value = random_value(rng, largest)
+        try:
+            badge_nvm.nvm_save(name, value)
+            reference[name] = value
+        except full:
+            # A resave that does not fit loses the old value, one over quota keeps it
+            if name not in badge_nvm._nvm.map:
+                reference.pop(name, None)
+        return f"save {name} {value!r:.40}", badge_nvm
+
+    if roll < 0.7:
+        badge_nvm.nvm_free(name)
+        reference.pop(name, None)
+        return f"free {name}", badge_nvm
+
+    if roll < 0.8:
+        staged = dict(reference)
+        abort = rng.random() < 0.25
+        try:
+            with badge_nvm.nvm_batch():
+                for _ in range(rng.randrange(1, 5)):
+                    name = random_name(rng, keys)
+                    if rng.random() < 0.7:
+                        staged[name] = random_value(rng, largest)
+                        badge_nvm.nvm_save(name, staged[name])
+                    else:
+                        staged.pop(name, None)
+                        badge_nvm.nvm_free(name)
+                if abort:
+                    raise FuzzFailure("abort")
+        except FuzzFailure:
+            return "batch aborted", badge_nvm
+        except full:
+            return "batch did not fit", badge_nvm
+        reference.clear()
+        reference.update(staged)
+        return "batch", badge_nvm
+
+    if roll < 0.83:
+        prefix = rng.choice(("app/ns0/", "app/ns1/", "app/", "key1"))
+        badge_nvm.nvm_free_prefix(prefix)
+        for name in [name for name in reference if name.startswith(prefix)]:
+            del reference[name]
+        return f"free_prefix {prefix}", badge_nvm
+
+    if roll < 0.85 and reference:
+        # Flip a byte in a saved value and expect a full fsck to find it
+        name = rng.choice(sorted(reference))
+        source, start, stop, _ = badge_nvm._nvm.locate(name)
+        if start == stop:
+            return "corrupt skipped", badge_nvm
+        offset = rng.randrange(start, stop)
+        source[offset] ^= 1 << rng.randrange(8)
+        damaged = badge_nvm.nvm_fsck()["damaged"]
+        if name not in damaged:
+            raise FuzzFailure(f"fsck missed damage to {name!r} at {offset}")
+        for name in damaged:
+            # A log store may fall back to an older copy of the entry
+            if name in badge_nvm._nvm.map:
+                reference[name] = badge_nvm.nvm_open(name)
+            else:
+                reference.pop(name, None)
+        return f"corrupt {name} at {offset}", badge_nvm
+
+    if roll < 0.9:
+        budget = rng.choice((None, 0, 1))
+        badge_nvm.nvm_compact(budget)
+        return f"compact {budget}", badge_nvm
+
+    return "reboot", nvm_sim.boot()
+
+def fuzz(args) -> int:
+    modes = [args.mode] if args.mode else ["slot", "log"]
+    for mode in modes:
+        for workload, (keys, largest, _, _, _) in WORKLOADS.items():
+            rng = random.Random(args.seed)
+            nvm, badge_nvm = open_store(mode, args.file)
+            quiet()
+            reference = {}
+            history = []
+            try:
+                for _ in range(args.ops):
+                    step, badge_nvm = fuzz_step(rng, badge_nvm, reference, keys, largest)
+                    quiet()
+                    history.append(step)
+                    check(badge_nvm, reference)
+            except Exception as e:
+                print(f"{mode}/{workload}: FAILED after {len(history)} ops with seed {args.seed}: {e!r}")
+                for step in history[-10:]:
+                    print(f"  {step}")
+                return 1
+            finally:
+                nvm.close()
+            print(f"{mode}/{workload}: {args.ops} ops ok, {nvm.bytes_written} bytes written")
+    return 0
+
+###############################################################################
+# Filling up
+
+# Saves in a row that must fail before the store counts as full
+FULL_AFTER = 20
+# Value bytes freed before saving into the store again
+FILL_FREED = 256
+
+def fill_round(rng: random.Random, badge_nvm, reference: dict, largest: int):
+    """Save until the store is full, then free a few entries and save into
+    the space they left. Returns badge_nvm, which is a new module after the
+    reboot at the end."""
+    failed = 0
+    while failed < FULL_AFTER:
+        # Mostly new names, resaving the same few could go on forever
+        name = f"key{rng.randrange(1 << 16)}"
+        value = bytes(rng.randrange(1, largest))
+        try:
+            badge_nvm.nvm_save(name, value)
+            reference[name] = value
+            failed = 0
+        except badge_nvm.MapSizeException:
+            failed = FULL_AFTER
+        except badge_nvm.MemoryBlockListException:
+            failed += 1
+            # A resave that does not fit loses the old value in a slot store
+            if name not in badge_nvm._nvm.map:
+                reference.pop(name, None)
+    check(badge_nvm, reference)
+
+    # Free a few entries, enough that the refill has to fit
+    freed = 0
+    for name in rng.sample(sorted(reference), len(reference)):
+        if freed >= FILL_FREED:
+            break
+        badge_nvm.nvm_free(name)
+        freed += len(reference.pop(name))
+    check(badge_nvm, reference)
+    reference["refill"] = b"r" * 40
+    badge_nvm.nvm_save("refill", reference["refill"])
+    check(badge_nvm, reference)
+
+    badge_nvm = nvm_sim.boot()
+    quiet()
+    check(badge_nvm, reference)
+    return badge_nvm
+
+def fill(args) -> int:
+    modes = [args.mode] if args.mode else ["slot", "log"]
+    for mode in modes:
+        for workload, (_, largest, _, _, _) in WORKLOADS.items():
+            rng = random.Random(args.seed)
+            nvm, badge_nvm = open_store(mode, args.file)
+            quiet()
+            reference = {}
+            rounds = 0
+            try:
+                for rounds in range(1, args.ops + 1):
+                    badge_nvm = fill_round(rng, badge_nvm, reference, largest)
+            except Exception as e:
+                print(f"{mode}/{workload}: FAILED in fill {rounds} with seed {args.seed}: {e!r}")
+                return 1
+            finally:
+                nvm.close()
+            print(f"{mode}/{workload}: filled {args.ops} times ok, {nvm.bytes_written} bytes written")
+    return 0
+
+###############################################################################
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("bench", "fuzz", "fill"))
+    parser.add_argument("--mode", choices=("slot", "log"), help="store to run, both by default")
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--file", help="back the NVM with this file instead of RAM")
+    args = parser.parse_args()
+    if args.seed is None:
+        args.seed = random.randrange(1 << 32)
+    return {"bench": bench, "fuzz": fuzz, "fill": fill}[args.command](args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Run badge_nvm and memory_block under CPython.
+
+The badge code only needs `microcontroller.nvm`, so install() puts a fake
+microcontroller module in sys.modules with an nvm backed by a bytearray, or
+by a memory mapped file when a path is given so the image survives between
+runs. boot() then imports badge_nvm fresh, which is the same as power
+cycling the badge: everything in RAM is gone and only the NVM is kept.
+
+    import nvm_sim
+    nvm = nvm_sim.install()
+    badge_nvm = nvm_sim.boot()
+    badge_nvm.nvm_save("name", "value")
+    print(nvm.writes, nvm.bytes_written)
+"""
+
+import importlib
+import mmap
+import os
+import sys
+import types
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+LIB_DIR = os.path.join(SRC_DIR, "lib")
+
+NVM_SIZE = 8192
+
+# Modules that hold NVM state in RAM, dropped by boot()
+_NVM_MODULES = ("badge_nvm", "nvm_log", "nvm_codec", "memory_block")
+
+###############################################################################
+
+class FakeNVM:
+    """Behaves like microcontroller.nvm: fixed size, indexed by int or slice,
+    and a slice assignment must be exactly as long as the slice."""
+
+    def __init__(self, size: int = NVM_SIZE, path: str = None):
+        self._file = None
+        if path is None:
+            self._data = bytearray(size)
+        else:
+            self._file = open(path, "a+b")
+            if os.path.getsize(path) < size:
+                self._file.truncate(size)
+            self._data = mmap.mmap(self._file.fileno(), size)
+        self._size = size
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.writes = 0
+        self.bytes_written = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytearray(self._data[key])
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._size)
+            if step != 1:
+                raise ValueError("Only slices with step=1 are supported")
+            if len(value) != stop - start:
+                raise ValueError("Slice and value different lengths")
+            self.bytes_written += len(value)
+        else:
+            if not 0 <= value <= 0xFF:
+                raise ValueError("Bytes must be in range 0-255")
+            self.bytes_written += 1
+        self.writes += 1
+        self._data[key] = value
+
+###############################################################################
+
+def install(size: int = NVM_SIZE, path: str = None) -> FakeNVM:
+    """Put a fake microcontroller module with a FakeNVM in sys.modules and
+    make src/ and src/lib importable."""
+    module = types.ModuleType("microcontroller")
+    module.nvm = FakeNVM(size, path)
+    sys.modules["microcontroller"] = module
+
+    for path in (SRC_DIR, LIB_DIR):
+        path = os.path.normpath(path)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return module.nvm
+
+def boot():
+    """Import badge_nvm as if the badge had just been powered on."""
+    if "microcontroller" not in sys.modules:
+        install()
+    for name in _NVM_MODULES:
+        sys.modules.pop(name, None)
+    return importlib.import_module("badge_nvm")